@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Benchmarks for the CSP compile and merge hot path.
+
+Run from the repository root:
+
+    python benchmarks/bench_csp.py --output results.json
+    python benchmarks/bench_csp.py --compare results.json
+
+Results are written as JSON, one entry per benchmark, with timings in microseconds per call.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmark',
+        ALLOWED_HOSTS=['*'],
+        INSTALLED_APPS=['csp_advanced'],
+        LOGGING_CONFIG=None,
+    )
+    django.setup()
+
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from csp_advanced.csp import CSPCompiler  # noqa: E402
+from csp_advanced.middleware import AdvancedCSPMiddleware  # noqa: E402
+from csp_advanced.utils import call_csp_dict, merge_csp_dict  # noqa: E402
+
+SIZES = (5, 20, 50, 200)
+DIRECTIVES = ('default-src', 'script-src', 'style-src', 'img-src', 'connect-src', 'font-src')
+
+
+def make_policy(size, callables=0):
+    policy = {}
+    for index, directive in enumerate(DIRECTIVES):
+        sources = ['self'] + ['https://cdn%d.%s.example.com' % (i, directive) for i in range(size - 1)]
+        if index < callables:
+            policy[directive] = lambda request, response, sources=sources: sources
+        else:
+            policy[directive] = sources
+    policy['report-uri'] = '/csp-report/'
+    return policy
+
+
+def make_update(size):
+    return {'script-src': ['https://extra%d.example.com' % i for i in range(size)]}
+
+
+def bench(func, repeat, number=None):
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    timings = [total / number * 1e6 for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min_us': min(timings),
+        'mean_us': sum(timings) / len(timings),
+        'max_us': max(timings),
+    }
+
+
+def compile_cases():
+    for size in SIZES:
+        policy = make_policy(size)
+        yield 'compile', {'size': size}, lambda policy=policy: CSPCompiler(policy).compile()
+
+
+def merge_cases():
+    for size in SIZES:
+        policy = make_policy(size)
+        update = make_update(5)
+        yield 'merge_csp_dict', {'size': size}, lambda policy=policy, update=update: merge_csp_dict(policy, update)
+
+
+def call_cases():
+    for size in SIZES:
+        for callables in (0, 1, len(DIRECTIVES)):
+            policy = make_policy(size, callables)
+            yield 'call_csp_dict', {'size': size, 'callables': callables}, \
+                lambda policy=policy: call_csp_dict(policy, None, None)
+
+
+def middleware_cases():
+    factory = RequestFactory()
+    request = factory.get('/')
+
+    for size in SIZES:
+        for callables in (0, 1, len(DIRECTIVES)):
+            for override in (False, True):
+                for cache_size in (128, 0):
+                    if cache_size == 0 and not override and not callables:
+                        continue
+                    with override_settings(ADVANCED_CSP=make_policy(size, callables),
+                                           ADVANCED_CSP_CACHE_SIZE=cache_size):
+                        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+                    update = make_update(5) if override else None
+
+                    def run(middleware=middleware, update=update):
+                        response = HttpResponse()
+                        if update is not None:
+                            response.csp = dict(update)
+                        return middleware.process_response(request, response)
+
+                    yield 'process_response', {
+                        'size': size, 'callables': callables, 'override': override, 'cache_size': cache_size,
+                    }, run
+
+
+SUITES = {
+    'compile': compile_cases,
+    'merge': merge_cases,
+    'call': call_cases,
+    'middleware': middleware_cases,
+}
+
+
+def run(suites, repeat):
+    results = []
+    empty = bench(HttpResponse, repeat)['min_us']
+    for suite in suites:
+        for name, params, func in SUITES[suite]():
+            result = {'name': name, 'params': params}
+            result.update(bench(func, repeat))
+            if name == 'process_response':
+                # Subtract the cost of constructing the response so only CSP handling is measured.
+                result['overhead_us'] = max(result['min_us'] - empty, 0)
+            results.append(result)
+            sys.stderr.write('%-18s %-70s %10.2f us\n' % (name, json.dumps(params, sort_keys=True), result['min_us']))
+    return results
+
+
+def key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(base, results):
+    base = {key(result): result for result in base['results']}
+    for result in results:
+        old = base.get(key(result))
+        if old is None:
+            continue
+        sys.stdout.write('%-18s %-70s %10.2f -> %10.2f us (%+.1f%%)\n' % (
+            result['name'], json.dumps(result['params'], sort_keys=True), old['min_us'], result['min_us'],
+            (result['min_us'] / old['min_us'] - 1) * 100,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suites', nargs='*', help='suites to run: %s (default: all)' % ', '.join(sorted(SUITES)))
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing repeats per benchmark')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='compare against a previous JSON result file')
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error('unknown suite: %s' % suite)
+
+    results = run(args.suites or sorted(SUITES), args.repeat)
+    document = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'results': results,
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    elif not args.compare:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,25 @@
 from django.contrib import admin
 
-# Register your models here.
+from csp_advanced.models import CSPPolicy, CSPViolation
+
+
+@admin.register(CSPViolation)
+class CSPViolationAdmin(admin.ModelAdmin):
+    list_display = ('directive', 'blocked_uri', 'document_uri', 'count', 'first_seen', 'last_seen')
+    list_filter = ('directive',)
+    # Prefix and exact searches can use the indexes, unlike the default substring search.
+    search_fields = ('^blocked_uri', '=fingerprint')
+    ordering = ('-last_seen',)
+    readonly_fields = ('fingerprint', 'directive', 'blocked_uri', 'document_uri', 'count', 'first_seen',
+                       'last_seen', 'samples')
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(CSPPolicy)
+class CSPPolicyAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'comment', 'created', 'updated')
+    ordering = ('-pk',)
+    readonly_fields = ('created', 'updated')
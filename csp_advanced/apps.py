@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class CspAdvancedConfig(AppConfig):
     name = 'csp_advanced'
+    default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        from csp_advanced import checks  # noqa: F401
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+from csp_advanced.csp import CSPCompiler
+from csp_advanced.policy import Policy
+
+
+class CSPCache(object):
+    def __init__(self, maxsize=128, compiler_options=None):
+        self.maxsize = maxsize
+        self.compiler_options = compiler_options or {}
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def compile(self, csp):
+        return self.compile_status(csp)[0]
+
+    def compile_status(self, csp):
+        if not self.maxsize:
+            return CSPCompiler(csp, **self.compiler_options).compile(), 'uncached'
+
+        # Policy objects are canonical and hashable, so they serve as their own cache key.
+        try:
+            key = Policy.from_dict(csp)
+            hash(key)
+        except TypeError:
+            return CSPCompiler(csp, **self.compiler_options).compile(), 'uncached'
+
+        with self.lock:
+            result = self.data.get(key)
+            if result is not None:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return result, 'hit'
+            self.misses += 1
+
+        # Compile outside the lock: two threads may compile the same policy at once,
+        # but that is cheaper than serialising every compilation.
+        result = CSPCompiler(key, **self.compiler_options).compile() if self.compiler_options else key.compile()
+
+        with self.lock:
+            self.data[key] = result
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+        return result, 'miss'
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
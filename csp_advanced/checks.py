@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+from csp_advanced.validation import normalize_csp, validate_csp
+
+POLICY_SETTINGS = ('ADVANCED_CSP', 'ADVANCED_CSP_REPORT_ONLY')
+ROUTE_SETTINGS = ('ADVANCED_CSP_ROUTES', 'ADVANCED_CSP_REPORT_ONLY_ROUTES')
+
+
+@register(Tags.security)
+def check_policies(app_configs, **kwargs):
+    policies = [(name, getattr(settings, name, None)) for name in POLICY_SETTINGS]
+    for setting in ROUTE_SETTINGS:
+        routes = getattr(settings, setting, None) or {}
+        policies.extend(('%s[%r]' % (setting, key), fragment) for key, fragment in routes.items())
+
+    endpoints = getattr(settings, 'ADVANCED_CSP_REPORTING_ENDPOINTS', None) or {}
+    errors = []
+    for name, csp in policies:
+        if not csp:
+            continue
+        csp = normalize_csp(csp)
+        errors.extend(Error(message, hint='Fix the policy in %s.' % (name,), obj=name, id='csp_advanced.E001')
+                      for message in validate_csp(csp))
+        group = csp.get('report-to') if isinstance(csp, dict) else None
+        if endpoints and isinstance(group, str) and group not in endpoints:
+            errors.append(Error('report-to refers to an unknown reporting endpoint: %s' % (group,),
+                                hint='Add it to ADVANCED_CSP_REPORTING_ENDPOINTS.', obj=name, id='csp_advanced.E002'))
+    return errors
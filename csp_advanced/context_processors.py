@@ -0,0 +1,3 @@
+def nonce(request):
+    # request.csp_nonce is lazy: the nonce is only generated if the template uses it.
+    return {'CSP_NONCE': getattr(request, 'csp_nonce', '')}
@@ -1,5 +1,9 @@
+import re
 from itertools import chain
 
+from csp_advanced.sources import KEYWORD_SOURCES, NON_SOURCE_LISTS, PREFIX_SOURCES, minify_sources
+from csp_advanced.utils import acall_csp_dict, call_csp_dict
+
 
 class InvalidCSPError(ValueError):
     pass
@@ -17,13 +21,19 @@ class CSPCompiler(object):
         'manifest-src',
         'media-src',
         'object-src',
+        'prefetch-src',
         'script-src',
+        'script-src-attr',
+        'script-src-elem',
         'style-src',
+        'style-src-attr',
+        'style-src-elem',
         'worker-src',
 
         # Navigation directives:
         'form-action',
         'frame-ancestors',
+        'navigate-to',
 
         # Document directives:
         'base-uri',
@@ -35,20 +45,9 @@ class CSPCompiler(object):
         'block-all-mixed-content',
     }
 
-    CSP_FETCH_SPECIAL = {
-        'self',
-        'none',
-        'unsafe-inline',
-        'unsafe-eval',
-        'strict-dynamic',
-    }
+    CSP_FETCH_SPECIAL = KEYWORD_SOURCES
 
-    CSP_PREFIX_SPECIAL = (
-        'nonce-',
-        'sha256-',
-        'sha384-',
-        'sha512-'
-    )
+    CSP_PREFIX_SPECIAL = PREFIX_SOURCES
 
     CSP_SANDBOX_VALID = {
         'allow-forms',
@@ -69,30 +68,99 @@ class CSPCompiler(object):
         'script style',
     }
 
-    def __init__(self, csp_dict):
+    CSP_TRUSTED_TYPES_SPECIAL = {
+        'none',
+        'allow-duplicates',
+    }
+
+    CSP_TRUSTED_TYPES_FOR_VALID = {
+        'script',
+    }
+
+    # List-valued directives that are not source lists.
+    CSP_LIST_SPECIAL = {
+        'sandbox',
+        'trusted-types',
+        'require-trusted-types-for',
+    }
+
+    # Fetch directives that fall back to other directives when absent, nearest first.
+    CSP_FALLBACKS = {
+        'child-src': ('default-src',),
+        'connect-src': ('default-src',),
+        'font-src': ('default-src',),
+        'frame-src': ('child-src', 'default-src'),
+        'img-src': ('default-src',),
+        'manifest-src': ('default-src',),
+        'media-src': ('default-src',),
+        'object-src': ('default-src',),
+        'prefetch-src': ('default-src',),
+        'script-src': ('default-src',),
+        'script-src-attr': ('script-src', 'default-src'),
+        'script-src-elem': ('script-src', 'default-src'),
+        'style-src': ('default-src',),
+        'style-src-attr': ('style-src', 'default-src'),
+        'style-src-elem': ('style-src', 'default-src'),
+        'worker-src': ('child-src', 'script-src', 'default-src'),
+    }
+
+    TRUSTED_TYPES_POLICY_RE = re.compile(r'^(?:\*|[A-Za-z0-9#=_/@.%-]+)$')
+
+    def __init__(self, csp_dict, minify=False, origin=None):
         self.csp = csp_dict
+        self.minify = minify
+        self.origin = origin
+        self.sizes = None
 
     def compile(self):
+        if not self.minify:
+            return self.compile_pieces(self.csp)
+
+        original = self.compile_pieces(self.csp)
+        result = self.compile_pieces(self.minify_csp(self.csp))
+        self.sizes = (len(original), len(result))
+        return result
+
+    def compile_pieces(self, csp):
         pieces = []
-        for name, value in self.csp.items():
-            if name in self.CSP_LISTS:
-                if value:
-                    pieces.append(self.compile_list(name, value))
-            elif name in self.CSP_BOOLEAN:
-                if value:
-                    pieces.append(name)
-            elif name == 'sandbox':
-                if value:
-                    pieces.append(self.compile_sandbox(value))
-            elif name == 'report-uri':
-                pieces.append(self.compile_report_uri(value))
-            elif name == 'require-sri-for':
-                pieces.append(self.compile_require_sri_for(value))
-            else:
-                raise InvalidCSPError('Unknown directive: %s' % (name,))
+        for name, value in csp.items():
+            piece = self.compile_directive(name, value)
+            if piece:
+                pieces.append(piece)
         return '; '.join(pieces)
 
+    def minify_directive(self, name, value):
+        if name in self.CSP_LISTS and name not in NON_SOURCE_LISTS and value:
+            self.ensure_list(name, value)
+            return minify_sources(value, self.origin)
+        return value
+
+    def minify_csp(self, csp):
+        result = {name: self.minify_directive(name, value) for name, value in csp.items()}
+
+        # A directive identical to the directive it falls back to is redundant.
+        redundant = set()
+        for name, fallbacks in self.CSP_FALLBACKS.items():
+            if not result.get(name):
+                continue
+            for fallback in fallbacks:
+                if result.get(fallback):
+                    if set(result[fallback]) == set(result[name]):
+                        redundant.add(name)
+                    break
+        return {name: value for name, value in result.items() if name not in redundant}
+
+    def compile_directive(self, name, value):
+        # One dict lookup per directive; the table is built once, below the methods.
+        try:
+            compiler = self.COMPILERS[name]
+        except KeyError:
+            raise InvalidCSPError('Unknown directive: %s' % (name,))
+        return compiler(self, name, value)
+
     def compile_list(self, name, value_list):
+        if not value_list:
+            return None
         self.ensure_list(name, value_list)
         values = [name]
         for value in value_list:
@@ -102,29 +170,115 @@ class CSPCompiler(object):
                 values.append(value)
         return ' '.join(values)
 
-    def compile_sandbox(self, values):
-        self.ensure_list('sandbox', values)
+    def compile_boolean(self, name, value):
+        return name if value else None
+
+    def compile_sandbox(self, name, values):
+        if not values:
+            return None
+        self.ensure_list(name, values)
         for value in values:
             if value not in self.CSP_SANDBOX_VALID:
                 raise InvalidCSPError('Unknown sandbox value: %s' % (value,))
-        return ' '.join(chain(['sandbox'], values))
+        return ' '.join(chain([name], values))
 
-    def compile_report_uri(self, value):
-        self.ensure_str('report-uri', value)
+    def compile_report_uri(self, name, value):
+        self.ensure_str(name, value)
         return 'report-uri %s' % value
 
-    def compile_require_sri_for(self, value):
-        self.ensure_str('require-sri-for', value)
+    def compile_report_to(self, name, value):
+        self.ensure_str(name, value)
+        return 'report-to %s' % value
+
+    def compile_require_sri_for(self, name, value):
+        self.ensure_str(name, value)
         if value not in self.CSP_REQUIRE_SRI_VALID:
             raise InvalidCSPError('Unknown require-sri-for value: %s' % (value,))
         return 'require-sri-for %s' % value
 
+    def compile_trusted_types(self, name, values):
+        if not values:
+            return None
+        self.ensure_list(name, values)
+        pieces = [name]
+        for value in values:
+            if value in self.CSP_TRUSTED_TYPES_SPECIAL:
+                pieces.append("'%s'" % value)
+            elif isinstance(value, str) and self.TRUSTED_TYPES_POLICY_RE.match(value):
+                pieces.append(value)
+            else:
+                raise InvalidCSPError('Invalid trusted-types policy name: %s' % (value,))
+        return ' '.join(pieces)
+
+    def compile_require_trusted_types_for(self, name, values):
+        if not values:
+            return None
+        self.ensure_list(name, values)
+        for value in values:
+            if value not in self.CSP_TRUSTED_TYPES_FOR_VALID:
+                raise InvalidCSPError('Unknown require-trusted-types-for value: %s' % (value,))
+        return ' '.join(chain([name], ("'%s'" % value for value in values)))
+
+    COMPILERS = dict.fromkeys(CSP_LISTS, compile_list)
+    COMPILERS.update(dict.fromkeys(CSP_BOOLEAN, compile_boolean))
+    COMPILERS.update({
+        'sandbox': compile_sandbox,
+        'trusted-types': compile_trusted_types,
+        'require-trusted-types-for': compile_require_trusted_types_for,
+        'require-sri-for': compile_require_sri_for,
+        'report-uri': compile_report_uri,
+        'report-to': compile_report_to,
+    })
+
+    @classmethod
+    def ensure_directive(cls, name):
+        if name not in cls.COMPILERS:
+            raise InvalidCSPError('Unknown directive: %s' % (name,))
+
     @staticmethod
     def ensure_list(name, value):
         if not isinstance(value, (list, tuple, set)):
-            raise InvalidCSPError('Values for %s must be list-like type, not %s', (name, type(value)))
+            raise InvalidCSPError('Values for %s must be list-like type, not %s' % (name, type(value).__name__))
 
     @staticmethod
     def ensure_str(name, value):
         if not isinstance(value, str):
-            raise InvalidCSPError('Values for %s must be a string type, not %s', (name, type(value)))
+            raise InvalidCSPError('Values for %s must be a string type, not %s' % (name, type(value).__name__))
+
+
+class PartialCSPCompiler(object):
+    def __init__(self, csp_dict, minify=False, origin=None):
+        compiler = CSPCompiler(csp_dict, minify, origin)
+        self.pieces = []
+        self.dynamic = []
+        self.callables = {}
+
+        for name, value in csp_dict.items():
+            if callable(value):
+                compiler.ensure_directive(name)
+                self.dynamic.append((len(self.pieces), name, value))
+                self.callables[name] = value
+                self.pieces.append(None)
+            else:
+                # Directives are minified one by one: fallbacks cannot be pruned next to unknown values.
+                if minify:
+                    value = compiler.minify_directive(name, value)
+                piece = compiler.compile_directive(name, value)
+                if piece:
+                    self.pieces.append(piece)
+        self.compiler = compiler
+
+    def evaluate(self, request, response):
+        return call_csp_dict(self.callables, request, response)
+
+    async def aevaluate(self, request, response):
+        return await acall_csp_dict(self.callables, request, response)
+
+    def compile(self, values):
+        pieces = list(self.pieces)
+        for index, name, func in self.dynamic:
+            value = values[name]
+            if self.compiler.minify:
+                value = self.compiler.minify_directive(name, value)
+            pieces[index] = self.compiler.compile_directive(name, value)
+        return '; '.join(piece for piece in pieces if piece)
@@ -0,0 +1,67 @@
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+from csp_advanced.csp import CSPCompiler
+from csp_advanced.policy import Policy
+from csp_advanced.utils import merge_csp_dict
+
+try:
+    from asgiref.sync import iscoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+
+class CSPOverride(object):
+    def __init__(self, csp=None, csp_report=None, replace=False, exempt=False):
+        # Fragments are validated when the view module is imported, not when the first response fails.
+        for fragment in (csp, csp_report):
+            if fragment:
+                CSPCompiler(Policy.from_dict(fragment)).compile()
+        self.fragments = {'csp': csp, 'csp_report': csp_report}
+        self.replace = replace
+        self.exempt = exempt
+
+        # Headers merged with static base policies, keyed by the middleware's CSPHeader objects.
+        # Weak keys let the headers go away with policies replaced by reloads or host cache expiry.
+        self.headers = WeakKeyDictionary()
+
+    def get_fragment(self, policy):
+        for attr in policy.attrs:
+            fragment = self.fragments.get(attr)
+            if fragment:
+                return fragment
+        return None
+
+    def apply(self, csp, fragment, dedupe=False):
+        if not self.replace:
+            return merge_csp_dict(csp, fragment, dedupe)
+        result = dict(csp.items())
+        result.update(fragment)
+        return result
+
+    def __call__(self, view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(*args, **kwargs):
+                response = await view(*args, **kwargs)
+                response.csp_override = self
+                return response
+        else:
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                response = view(*args, **kwargs)
+                response.csp_override = self
+                return response
+        return wrapper
+
+
+def csp_update(csp=None, csp_report=None):
+    return CSPOverride(csp, csp_report)
+
+
+def csp_replace(csp=None, csp_report=None):
+    return CSPOverride(csp, csp_report, replace=True)
+
+
+def csp_exempt(view):
+    return CSPOverride(exempt=True)(view)
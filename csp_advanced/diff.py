@@ -0,0 +1,67 @@
+from csp_advanced.csp import CSPCompiler
+from csp_advanced.policy import Policy
+
+
+def unquote_source(value):
+    if len(value) > 2 and value[0] == value[-1] == "'":
+        return value[1:-1]
+    return value
+
+
+def parse_csp(header):
+    csp = {}
+    for piece in header.split(';'):
+        tokens = piece.split()
+        if not tokens:
+            continue
+        name, values = tokens[0].lower(), tokens[1:]
+        if name in csp or name not in Policy.INDEX:
+            # Browsers ignore repeated directives. Verbatim policies may use directives the compiler does not know,
+            # which cannot be compared.
+            continue
+        if name in CSPCompiler.CSP_BOOLEAN:
+            csp[name] = True
+        elif name in Policy.LIST_DIRECTIVES:
+            csp[name] = [unquote_source(value) for value in values]
+        else:
+            csp[name] = ' '.join(values)
+    return csp
+
+
+def static_csp(csp):
+    # Only the parts of a policy known before a request can be compared.
+    if isinstance(csp, str):
+        return parse_csp(csp)
+    if not isinstance(csp, dict):
+        return {}
+    return {name: value for name, value in csp.items() if not callable(value) and name != 'override'}
+
+
+def diff_policies(old, new):
+    old, new = Policy.from_dict(old), Policy.from_dict(new)
+    result = {}
+    for name in Policy.DIRECTIVES:
+        before, after = old.get(name), new.get(name)
+        if before == after:
+            continue
+        if name in Policy.LIST_DIRECTIVES:
+            before, after = before or (), after or ()
+            added = [value for value in after if value not in before]
+            removed = [value for value in before if value not in after]
+            # An empty list compiles to nothing, exactly like a missing directive.
+            if added or removed:
+                result[name] = {'added': added, 'removed': removed}
+        else:
+            result[name] = {'old': before, 'new': after}
+    return result
+
+
+def format_diff(diff):
+    lines = []
+    for name, change in diff.items():
+        if 'added' in change:
+            lines.extend('%s: + %s' % (name, value) for value in change['added'])
+            lines.extend('%s: - %s' % (name, value) for value in change['removed'])
+        else:
+            lines.append('%s: %r -> %r' % (name, change['old'], change['new']))
+    return lines
@@ -0,0 +1,97 @@
+import base64
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+
+INLINE_RE = re.compile(r'<(script|style)\b([^>]*)>(.*?)</\1\s*>', re.IGNORECASE | re.DOTALL)
+SRC_RE = re.compile(r'\bsrc\s*=', re.IGNORECASE)
+TEMPLATE_SYNTAX_RE = re.compile(r'{[{%#]')
+DEPENDENCY_RE = re.compile(r'{%\s*(?:extends|include)\s+["\']([^"\']+)["\']')
+
+INLINE_DIRECTIVES = {
+    'script': 'script-src',
+    'style': 'style-src',
+}
+
+
+def hash_source(content, algorithm='sha256'):
+    digest = hashlib.new(algorithm, content.encode('utf-8')).digest()
+    return '%s-%s' % (algorithm, base64.b64encode(digest).decode('ascii'))
+
+
+@lru_cache(maxsize=1024)
+def cached_hash_source(content, algorithm='sha256'):
+    return hash_source(content, algorithm)
+
+
+def merge_hashes(target, hashes):
+    for directive, values in hashes.items():
+        existing = target.setdefault(directive, [])
+        existing.extend(value for value in values if value not in existing)
+    return target
+
+
+def find_inline_hashes(text, algorithm='sha256', static_only=False, hasher=hash_source):
+    result = {}
+    for tag, attrs, content in INLINE_RE.findall(text):
+        tag = tag.lower()
+        if not content or (tag == 'script' and SRC_RE.search(attrs)):
+            continue
+        # Blocks containing template syntax only have a known hash once rendered.
+        if static_only and TEMPLATE_SYNTAX_RE.search(content):
+            continue
+        merge_hashes(result, {INLINE_DIRECTIVES[tag]: [hasher(content, algorithm)]})
+    return result
+
+
+def find_templates(dirs):
+    templates = {}
+    for directory in dirs:
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                # Earlier directories take precedence, like the template loaders.
+                templates.setdefault(name, path)
+    return templates
+
+
+def build_hash_index(dirs, algorithm='sha256'):
+    hashes = {}
+    dependencies = {}
+    for name, path in find_templates(dirs).items():
+        try:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+        except (UnicodeDecodeError, OSError):
+            continue
+        hashes[name] = find_inline_hashes(text, algorithm, static_only=True)
+        dependencies[name] = DEPENDENCY_RE.findall(text)
+
+    def resolve(name, seen):
+        result = {}
+        seen.add(name)
+        merge_hashes(result, hashes.get(name, {}))
+        for dependency in dependencies.get(name, ()):
+            if dependency not in seen:
+                merge_hashes(result, resolve(dependency, seen))
+        return result
+
+    index = {}
+    for name in hashes:
+        result = resolve(name, set())
+        if result:
+            index[name] = result
+    return index
+
+
+def load_hash_index(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_hash_index(path, index):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
@@ -0,0 +1,46 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class HostPolicyCache(object):
+    def __init__(self, loader, maxsize=1024, ttl=300):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, host):
+        entry = self.data.get(host)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            # Reads skip the lock; the host may have been evicted by another thread in the meantime.
+            try:
+                self.data.move_to_end(host)
+            except KeyError:
+                pass
+            return entry[0]
+        return self.load(host)
+
+    def is_fresh(self, host):
+        entry = self.data.get(host)
+        return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def load(self, host):
+        # Like CSPCache, two threads may load the same host at once rather than serialising all loads.
+        value = self.loader(host)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            self.data[host] = (value, expires)
+            self.data.move_to_end(host)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def warm(self, hosts):
+        for host in hosts:
+            self.load(host)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
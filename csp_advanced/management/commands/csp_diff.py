@@ -0,0 +1,53 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from csp_advanced.csp import InvalidCSPError
+from csp_advanced.diff import diff_policies, format_diff, static_csp
+from csp_advanced.validation import normalize_csp
+
+
+class Command(BaseCommand):
+    help = 'Shows the directives and sources that differ between two policies.'
+
+    def add_arguments(self, parser):
+        for name in ('old', 'new'):
+            parser.add_argument(name, help='A setting name such as ADVANCED_CSP, a JSON file, a JSON object, '
+                                           'or a Content-Security-Policy header value.')
+        parser.add_argument('--json', action='store_true', help='Print the difference as JSON.')
+
+    def load_policy(self, value):
+        if value.isupper() and hasattr(settings, value):
+            csp = getattr(settings, value) or {}
+            # ADVANCED_CSP_CANARY holds the candidate policy next to its sampling options.
+            if isinstance(csp, dict) and 'policy' in csp:
+                csp = csp['policy']
+        elif os.path.isfile(value):
+            with open(value) as f:
+                csp = self.load_json(f.read(), value)
+        elif value.lstrip().startswith('{'):
+            csp = self.load_json(value, 'argument')
+        else:
+            csp = value
+        return static_csp(normalize_csp(csp))
+
+    @staticmethod
+    def load_json(data, source):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise CommandError('Invalid JSON policy in %s: %s' % (source, e))
+
+    def handle(self, *args, **options):
+        try:
+            diff = diff_policies(self.load_policy(options['old']), self.load_policy(options['new']))
+        except InvalidCSPError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(diff, indent=2, sort_keys=True))
+        else:
+            for line in format_diff(diff):
+                self.stdout.write(line)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.template.backends.django import DjangoTemplates
+from django.template.utils import get_app_template_dirs
+
+from csp_advanced.hashes import build_hash_index, save_hash_index
+
+
+class Command(BaseCommand):
+    help = 'Hashes inline <script> and <style> blocks in templates into a CSP hash index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=getattr(settings, 'ADVANCED_CSP_HASH_INDEX', None),
+                            help='Where to write the index. Defaults to ADVANCED_CSP_HASH_INDEX.')
+        parser.add_argument('--algorithm', choices=('sha256', 'sha384', 'sha512'),
+                            default=getattr(settings, 'ADVANCED_CSP_HASH_ALGORITHM', 'sha256'))
+
+    def get_template_dirs(self):
+        dirs = []
+        for engine in engines.all():
+            if not isinstance(engine, DjangoTemplates):
+                continue
+            dirs.extend(engine.engine.dirs)
+            if engine.engine.app_dirs:
+                dirs.extend(get_app_template_dirs('templates'))
+        return dirs
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('Set ADVANCED_CSP_HASH_INDEX or pass --output.')
+
+        index = build_hash_index(self.get_template_dirs(), options['algorithm'])
+        save_hash_index(options['output'], index)
+        self.stdout.write('Hashed inline blocks in %d templates into %s' % (len(index), options['output']))
@@ -0,0 +1,58 @@
+import json
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management.base import BaseCommand, CommandError
+
+from csp_advanced.profiling import load_records, replay
+
+
+class Command(BaseCommand):
+    help = 'Replays recorded requests through the CSP middleware and reports where the time and bytes go.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('requests', help='A JSON lines file with one {"path", "host", "headers"} object per '
+                                             'request. "method", "status" and "content_type" are optional.')
+        parser.add_argument('--repeat', type=int, default=1, help='Replay every request this many times.')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        try:
+            with open(options['requests']) as f:
+                records = list(load_records(f))
+        except (OSError, ValueError) as e:
+            raise CommandError('Could not read %s: %s' % (options['requests'], e))
+
+        try:
+            report = replay(records, options['repeat'])
+        except MiddlewareNotUsed:
+            raise CommandError('No Content Security Policy is configured.')
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+
+        self.stdout.write('Replayed %d requests' % report['requests'])
+        self.write_table('Callable latency (ms)', report['callables_ms'], '%.3f')
+        self.write_table('Middleware time (ms)', report['phases_ms'], '%.3f')
+        self.write_table('Header size (bytes)', report['header_bytes'], '%d')
+        self.stdout.write('')
+        self.stdout.write('Distinct headers')
+        for header, count in report['distinct_headers'].items():
+            self.stdout.write('  %-40s %d' % (header, count))
+        self.stdout.write('')
+        self.stdout.write('Compile status')
+        for key, count in report['statuses'].items():
+            self.stdout.write('  %-40s %d' % (key, count))
+
+    def write_table(self, title, rows, number):
+        self.stdout.write('')
+        self.stdout.write(title)
+        if not rows:
+            self.stdout.write('  (none)')
+            return
+        self.stdout.write('  %-40s %8s %10s %10s %10s %10s' % ('', 'count', 'p50', 'p90', 'p99', 'max'))
+        for name, row in rows.items():
+            values = tuple(number % row[key] for key in ('p50', 'p90', 'p99', 'max'))
+            self.stdout.write('  %-40s %8d %10s %10s %10s %10s' % ((name, row['count']) + values))
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from functools import update_wrapper
+from inspect import isawaitable
+
+
+class SharedAwaitable(object):
+    # Lets several policies await one async callable result; the first await schedules it as a task.
+    def __init__(self, awaitable):
+        self.awaitable = awaitable
+        self.future = None
+
+    def __await__(self):
+        if self.future is None:
+            self.future = asyncio.ensure_future(self.awaitable)
+        return self.future.__await__()
+
+
+def call_csp_value(func, request, response):
+    memo = getattr(request, 'csp_memo', None)
+    if memo is None:
+        return func(request, response)
+
+    # The same callable in several directives, or in both policies, runs once per request.
+    key = getattr(func, 'csp_memo_key', func)
+    try:
+        return memo[key]
+    except KeyError:
+        pass
+    result = func(request, response)
+    if isawaitable(result):
+        result = SharedAwaitable(result)
+    memo[key] = result
+    return result
+
+
+class CachedCSPValue(object):
+    def __init__(self, func, key, timeout=None, maxsize=128):
+        self.func = func
+        self.key = key
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        update_wrapper(self, func)
+
+    def __call__(self, request, response):
+        key = self.key(request)
+        if key is None:
+            return self.func(request, response)
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    return value
+                del self.data[key]
+
+        result = self.func(request, response)
+        if isawaitable(result):
+            return self.astore(key, result)
+        return self.store(key, result)
+
+    async def astore(self, key, result):
+        return self.store(key, await result)
+
+    def store(self, key, value):
+        expires = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def cache_csp_value(key, timeout=None, maxsize=128):
+    def decorator(func):
+        return CachedCSPValue(func, key, timeout, maxsize)
+    return decorator
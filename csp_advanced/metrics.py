@@ -0,0 +1,133 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+# Sent with sample=ResponseSample after every response when SignalMetrics is the backend.
+csp_response_measured = Signal()
+
+
+class ResponseSample(object):
+    __slots__ = ('timings', 'sizes', 'statuses', 'phase', 'created', 'started', 'total')
+
+    PHASES = ('evaluate', 'merge', 'compile')
+
+    def __init__(self):
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self.sizes = {}
+        self.statuses = {}
+        self.phase = None
+        self.created = self.started = perf_counter()
+        self.total = None
+
+    def start(self, phase):
+        now = perf_counter()
+        if self.phase is not None:
+            self.timings[self.phase] += now - self.started
+        self.phase = phase
+        self.started = now
+
+    def stop(self):
+        self.start(None)
+
+    def finish(self):
+        self.stop()
+        self.total = self.started - self.created
+
+    def record(self, header, status, value=None):
+        # status is precompiled, partial, hit, miss or uncached.
+        self.statuses[header] = status
+        if value is not None:
+            self.sizes[header] = len(value.encode('utf-8'))
+
+
+class SignalMetrics(object):
+    def record(self, sample):
+        csp_response_measured.send(sender=self.__class__, sample=sample)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %r' % (name, labels.rstrip(','), self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','), cumulative))
+        return lines
+
+
+class PrometheusMetrics(object):
+    SECONDS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+    BYTES_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384)
+
+    def __init__(self, prefix='csp_advanced'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.bytes = {}
+        self.statuses = {}
+
+    def record(self, sample):
+        with self.lock:
+            for phase, value in sample.timings.items():
+                self.observe(self.seconds, phase, self.SECONDS_BUCKETS, value)
+            self.observe(self.seconds, 'total', self.SECONDS_BUCKETS, sample.total)
+            for header, size in sample.sizes.items():
+                self.observe(self.bytes, header, self.BYTES_BUCKETS, size)
+            for key in sample.statuses.items():
+                self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    @staticmethod
+    def observe(histograms, key, buckets, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def render(self):
+        seconds = '%s_response_seconds' % self.prefix
+        size = '%s_header_bytes' % self.prefix
+        headers = '%s_headers_total' % self.prefix
+        lines = [
+            '# HELP %s Time spent by the CSP middleware per response, by phase.' % seconds,
+            '# TYPE %s histogram' % seconds,
+        ]
+        with self.lock:
+            for phase, histogram in sorted(self.seconds.items()):
+                lines.extend(histogram.render(seconds, 'phase="%s",' % phase))
+            lines.append('# HELP %s Size of the CSP headers sent.' % size)
+            lines.append('# TYPE %s histogram' % size)
+            for header, histogram in sorted(self.bytes.items()):
+                lines.extend(histogram.render(size, 'header="%s",' % header))
+            lines.append('# HELP %s CSP headers sent, by how they were compiled.' % headers)
+            lines.append('# TYPE %s counter' % headers)
+            for (header, status), count in sorted(self.statuses.items()):
+                lines.append('%s{header="%s",status="%s"} %d' % (headers, header, status, count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics_backends = {}
+
+
+def get_metrics_backend():
+    backend = getattr(settings, 'ADVANCED_CSP_METRICS', None)
+    if not isinstance(backend, str):
+        return backend
+    # Backends configured by path are shared, so the exporter view sees what the middleware records.
+    if backend not in metrics_backends:
+        metrics_backends[backend] = import_string(backend)()
+    return metrics_backends[backend]
@@ -0,0 +1,10 @@
+from django.urls import path
+
+from csp_advanced import views
+
+# Kept apart from csp_advanced.urls, whose report endpoint is public, so the exporter is only mounted on purpose.
+app_name = 'csp_advanced_metrics'
+
+urlpatterns = [
+    path('', views.metrics, name='metrics'),
+]
@@ -1,63 +1,581 @@
+import asyncio
 import logging
+import threading
+import time
+from itertools import chain
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.exceptions import MiddlewareNotUsed
+from django.core.exceptions import DisallowedHost, ImproperlyConfigured, MiddlewareNotUsed
+from django.utils.module_loading import import_string
+
+from csp_advanced.cache import CSPCache
+from csp_advanced.csp import CSPCompiler, InvalidCSPError, PartialCSPCompiler
+from csp_advanced.diff import diff_policies, format_diff, static_csp
+from csp_advanced.hashes import load_hash_index, merge_hashes
+from csp_advanced.hosts import HostPolicyCache
+from csp_advanced.metrics import ResponseSample, get_metrics_backend
+from csp_advanced.policy import Policy
+from csp_advanced.reports import compile_report_to, compile_reporting_endpoints
+from csp_advanced.routing import PolicyRouter
+from csp_advanced.sampling import Sampler
+from csp_advanced.utils import acall_csp_dict, add_nonce_csp_dict, add_sources_csp_dict, call_csp_dict, \
+    get_used_nonce, is_callable_csp_dict, lazy_nonce, merge_csp_dict, \
+    merge_csp_fragment, strip_reporting_csp
+from csp_advanced.validation import check_callables, normalize_csp
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
 
-from csp_advanced.csp import CSPCompiler, InvalidCSPError
-from csp_advanced.utils import is_callable_csp_dict, call_csp_dict, merge_csp_dict
 
 log = logging.getLogger(__name__)
 
 
+class CSPHeader(object):
+    def __init__(self, header, csp, attrs, compiler_options=None):
+        self.header = header
+        self.csp = csp
+        self.attrs = attrs
+        self.is_str = isinstance(csp, str)
+        self.callable = is_callable_csp_dict(csp)
+
+        # Static policies are compiled once here, so that invalid policies fail at startup
+        # and every response can reuse the same header string.
+        self.compiled = None
+        self.partial = None
+        self.policy = None
+        self.sizes = None
+        if self.is_str:
+            self.compiled = csp
+        elif not self.callable:
+            self.policy = Policy.from_dict(csp)
+            compiler = CSPCompiler(self.policy, **compiler_options or {})
+            self.compiled = compiler.compile()
+            self.sizes = compiler.sizes
+        elif not callable(csp):
+            # Only some directives are callable: compile the rest now and splice in the
+            # dynamic directives per request.
+            self.partial = PartialCSPCompiler(csp, **compiler_options or {})
+
+    def evaluate(self, request, response):
+        if not self.callable or self.header in response:
+            return None
+        if self.partial is not None:
+            return self.partial.evaluate(request, response)
+        return call_csp_dict(self.csp, request, response)
+
+    async def aevaluate(self, request, response):
+        if not self.callable or self.header in response:
+            return None
+        if self.partial is not None:
+            return await self.partial.aevaluate(request, response)
+        return await acall_csp_dict(self.csp, request, response)
+
+    def resolve(self, values):
+        if not self.callable:
+            return self.policy
+        if self.partial is not None:
+            return {name: values.get(name, value) for name, value in self.csp.items()}
+        return values
+
+    def get_update(self, response):
+        for attr in self.attrs:
+            update = getattr(response, attr, None)
+            if update is not None:
+                return update
+        return None
+
+
+class CSPPolicySet(object):
+    def __init__(self, enforced, report, unsampled_report):
+        self.enforced = enforced
+        self.report = report
+        self.policies = [policy for policy in (enforced, report) if policy is not None]
+        self.unsampled = [policy for policy in (enforced, unsampled_report) if policy is not None]
+
+
 class AdvancedCSPMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
+    # Documents that can run script: HTML, SVG and XML, which may embed XHTML or SVG elements.
+    SCRIPTABLE_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'image/svg+xml', 'application/xml', 'text/xml')
+
     def __init__(self, get_response=None):
         self.get_response = get_response
-        self.enforced_csp = getattr(settings, 'ADVANCED_CSP', None) or {}
-        self.enforced_csp_is_str = isinstance(self.enforced_csp, str)
-        self.enforced_csp_callable = is_callable_csp_dict(self.enforced_csp)
-        self.report_csp = getattr(settings, 'ADVANCED_CSP_REPORT_ONLY', None) or {}
-        self.report_csp_callable = is_callable_csp_dict(self.report_csp)
-        self.report_csp_is_str = isinstance(self.enforced_csp, str)
-        self.report_only_csp = not self.enforced_csp
-
-        if not self.enforced_csp and not self.report_csp:
+        self.is_async = get_response is not None and iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+        self.enforced_csp = self.settings_csp = normalize_csp(getattr(settings, 'ADVANCED_CSP', None) or {})
+        self.report_csp = self.settings_report_csp = normalize_csp(
+            getattr(settings, 'ADVANCED_CSP_REPORT_ONLY', None) or {})
+        self.logged_errors = set()
+        self.compiler_options = {
+            'minify': True,
+            'origin': getattr(settings, 'ADVANCED_CSP_ORIGIN', None),
+        } if getattr(settings, 'ADVANCED_CSP_MINIFY', False) else {}
+        self.cache = CSPCache(getattr(settings, 'ADVANCED_CSP_CACHE_SIZE', 128), self.compiler_options)
+        self.header_budget = getattr(settings, 'ADVANCED_CSP_HEADER_BUDGET', None)
+        self.header_budget_strict = getattr(settings, 'ADVANCED_CSP_HEADER_BUDGET_STRICT', False)
+        self.dedupe = getattr(settings, 'ADVANCED_CSP_DEDUPE', False)
+        self.metrics = get_metrics_backend()
+        self.reporting_endpoints = getattr(settings, 'ADVANCED_CSP_REPORTING_ENDPOINTS', None) or {}
+        self.reporting_headers = self.build_reporting_headers(self.reporting_endpoints)
+        self.nonce_directives = getattr(settings, 'ADVANCED_CSP_NONCE_DIRECTIVES', ('script-src', 'style-src'))
+        self.streaming_mode = getattr(settings, 'ADVANCED_CSP_STREAMING', 'minimal')
+        self.streaming_header = self.build_streaming_header(self.streaming_mode)
+
+        self.provider = getattr(settings, 'ADVANCED_CSP_PROVIDER', None)
+        if isinstance(self.provider, str):
+            self.provider = import_string(self.provider)()
+        self.provider_interval = getattr(settings, 'ADVANCED_CSP_PROVIDER_INTERVAL', 5.0)
+        self.provider_lock = threading.Lock()
+        self.provider_version = None
+        self.provider_next_check = 0
+
+        self.host_policies = getattr(settings, 'ADVANCED_CSP_HOST_POLICIES', None)
+        if isinstance(self.host_policies, str):
+            self.host_policies = import_string(self.host_policies)
+        self.hosts = HostPolicyCache(
+            self.load_host_policies,
+            getattr(settings, 'ADVANCED_CSP_HOST_CACHE_SIZE', 1024),
+            getattr(settings, 'ADVANCED_CSP_HOST_CACHE_TTL', 300),
+        ) if self.host_policies is not None else None
+
+        if not self.enforced_csp and not self.report_csp and self.provider is None and self.hosts is None:
             raise MiddlewareNotUsed()
 
-    def add_csp_header(self, request, response, header, base, can_call, is_str, attrs):
-        if header in response:
+        self.hash_index = self.load_hash_index(getattr(settings, 'ADVANCED_CSP_HASH_INDEX', None))
+
+        self.report_sampler = None
+        self.report_sampling_mode = None
+        sampling = getattr(settings, 'ADVANCED_CSP_REPORT_ONLY_SAMPLING', None)
+        if sampling:
+            sampling = dict(sampling)
+            self.report_sampling_mode = sampling.pop('mode', 'header')
+            if self.report_sampling_mode not in ('header', 'reporting'):
+                raise ImproperlyConfigured("ADVANCED_CSP_REPORT_ONLY_SAMPLING mode must be 'header' or 'reporting'")
+            self.report_sampler = Sampler(**sampling)
+
+        self.canary_csp = None
+        self.canary_sampler = None
+        canary = getattr(settings, 'ADVANCED_CSP_CANARY', None)
+        if canary:
+            canary = dict(canary)
+            self.canary_csp = normalize_csp(canary.pop('policy'))
+            self.canary_sampler = Sampler(**canary)
+
+        self.routes = {key: normalize_csp(fragment) for key, fragment in
+                       (getattr(settings, 'ADVANCED_CSP_ROUTES', None) or {}).items()}
+        self.report_routes = {key: normalize_csp(fragment) for key, fragment in
+                              (getattr(settings, 'ADVANCED_CSP_REPORT_ONLY_ROUTES', None) or {}).items()}
+        self.load_policies(self.enforced_csp, self.report_csp)
+        if self.provider is not None:
+            self.refresh()
+
+        warmup = getattr(settings, 'ADVANCED_CSP_HOST_WARMUP', None)
+        if warmup and self.hosts is not None:
+            self.hosts.warm(warmup() if callable(warmup) else warmup)
+
+    def load_policies(self, enforced_csp, report_csp):
+        # Everything is built before any attribute is replaced, so an invalid policy changes nothing.
+        default = self.build_policy_set(enforced_csp, report_csp, self.get_report_attrs(enforced_csp))
+        router = self.build_router(enforced_csp, report_csp)
+        canary = canary_diff = None
+        if self.canary_csp:
+            # The candidate replaces the report-only policy on sampled requests; both variants are precompiled.
+            canary = self.build_policy_set(enforced_csp, self.canary_csp, self.get_report_attrs(enforced_csp))
+            canary_diff = diff_policies(static_csp(enforced_csp), static_csp(self.canary_csp))
+            for line in format_diff(canary_diff) or ['no changes']:
+                log.info('CSP canary differs from the enforced policy: %s', line)
+        self.canary = canary
+        self.canary_diff = canary_diff
+        self.enforced_csp = enforced_csp
+        self.report_csp = report_csp
+        self.router = router
+        self.default = default
+        # Sites that only report must not start enforcing on downloads.
+        self.streaming_headers = tuple(policy.header for policy in default.policies)
+        self.enforced = default.enforced
+        self.report = default.report
+        self.policies = default.policies
+        if self.hosts is not None:
+            self.hosts.clear()
+
+    def refresh_due(self):
+        return self.provider is not None and time.monotonic() >= self.provider_next_check
+
+    def refresh(self):
+        # Only one thread checks the version; the others keep serving the current policies.
+        if not self.provider_lock.acquire(blocking=False):
             return
-        if is_str:
-            response[header] = base
+        try:
+            if time.monotonic() < self.provider_next_check:
+                return
+            self.provider_next_check = time.monotonic() + self.provider_interval
+            version = self.provider.get_version()
+            if version is None or version == self.provider_version:
+                return
+            self.provider_version = version
+            enforced_csp, report_csp = self.provider.get_policies()
+            self.load_policies(self.settings_csp if enforced_csp is None else normalize_csp(enforced_csp),
+                               self.settings_report_csp if report_csp is None else normalize_csp(report_csp))
+            log.info('Loaded CSP policy version %s', version)
+        except Exception:
+            log.exception('Failed to load CSP policy from %s', type(self.provider).__name__)
+        finally:
+            self.provider_lock.release()
+
+    def build_policy_set(self, enforced_csp, report_csp, report_attrs):
+        enforced = CSPHeader('Content-Security-Policy', check_callables(enforced_csp),
+                             ('csp',), self.compiler_options) if enforced_csp else None
+        report = CSPHeader('Content-Security-Policy-Report-Only', check_callables(report_csp),
+                           report_attrs, self.compiler_options) if report_csp else None
+
+        unsampled = report
+        if self.report_sampler is not None and report is not None:
+            # Requests outside the sample get either no report-only header, or one that cannot report.
+            unsampled = CSPHeader(report.header, strip_reporting_csp(report_csp), report.attrs,
+                                  self.compiler_options) if self.report_sampling_mode == 'reporting' else None
+
+        for policy in (enforced, report):
+            if policy is None:
+                continue
+            self.check_report_to(policy)
+            if policy.sizes is not None:
+                log.info('Minified %s from %d to %d bytes', policy.header, *policy.sizes)
+            if policy.compiled and not self.check_budget(policy.header, policy.compiled) and \
+                    self.header_budget_strict:
+                raise ImproperlyConfigured('%s exceeds ADVANCED_CSP_HEADER_BUDGET' % (policy.header,))
+        return CSPPolicySet(enforced, report, unsampled)
+
+    def build_streaming_header(self, mode):
+        if mode not in ('minimal', 'skip', 'full'):
+            raise ImproperlyConfigured("ADVANCED_CSP_STREAMING must be 'minimal', 'skip' or 'full'")
+        if mode != 'minimal':
+            return None
+        csp = normalize_csp(getattr(settings, 'ADVANCED_CSP_STREAMING_POLICY', {'default-src': ['none']}))
+        if is_callable_csp_dict(csp):
+            raise ImproperlyConfigured('ADVANCED_CSP_STREAMING_POLICY cannot contain callables')
+        return CSPHeader('Content-Security-Policy', csp or {}, {}, self.compiler_options).compiled or None
+
+    @staticmethod
+    def build_reporting_headers(endpoints):
+        if not endpoints:
+            return ()
+        headers = [('Reporting-Endpoints', compile_reporting_endpoints(endpoints))]
+        if getattr(settings, 'ADVANCED_CSP_REPORT_TO_HEADER', False):
+            headers.append(('Report-To', compile_report_to(
+                endpoints, getattr(settings, 'ADVANCED_CSP_REPORT_TO_MAX_AGE', 86400))))
+        return tuple(headers)
+
+    def check_report_to(self, policy):
+        if not self.reporting_endpoints or not isinstance(policy.csp, dict):
             return
-        csp = call_csp_dict(base, request, response) if can_call else base
+        group = policy.csp.get('report-to')
+        if isinstance(group, str) and group not in self.reporting_endpoints:
+            raise ImproperlyConfigured('%s reports to %r, which is not in ADVANCED_CSP_REPORTING_ENDPOINTS' %
+                                       (policy.header, group))
 
-        for attr in attrs:
-            update = getattr(response, attr, None)
+    def build_router(self, enforced_csp, report_csp):
+        routes = {}
+        report_attrs = self.get_report_attrs(enforced_csp)
+        for key in chain(self.routes, self.report_routes):
+            if key in routes:
+                continue
+            routes[key] = self.build_policy_set(
+                self.merge_route(enforced_csp, self.routes.get(key), key),
+                self.merge_route(report_csp, self.report_routes.get(key), key),
+                report_attrs,
+            )
+        return PolicyRouter(routes) if routes else None
+
+    @staticmethod
+    def get_report_attrs(enforced_csp):
+        # Without an enforced policy, response.csp applies to the report-only policy.
+        return ('csp_report',) if enforced_csp else ('csp_report', 'csp')
+
+    def load_host_policies(self, host):
+        # Failures are cached like policies, so a broken host is retried once per TTL, not per request.
+        try:
+            result = self.host_policies(host)
+            if result is None:
+                return None
+            enforced_csp = self.merge_route(self.enforced_csp, normalize_csp(result[0]), host)
+            report_csp = self.merge_route(self.report_csp, normalize_csp(result[1]), host)
+            return self.build_policy_set(enforced_csp, report_csp, self.get_report_attrs(enforced_csp))
+        except Exception:
+            log.exception('Failed to load the CSP policy for host %s', host)
+            return None
+
+    @staticmethod
+    def get_request_host(request):
+        try:
+            return request.get_host().lower()
+        except DisallowedHost:
+            return None
+
+    @staticmethod
+    def merge_route(base, fragment, key):
+        if fragment is None:
+            return base
+        if isinstance(base, str) and not fragment.get('override'):
+            raise ImproperlyConfigured('CSP route %s must set override, because the base policy is a string' % (key,))
+        return merge_csp_fragment(base or {}, fragment)
+
+    def check_budget(self, header, value, path=None):
+        if self.header_budget is None:
+            return True
+        size = len(value.encode('utf-8'))
+        if size <= self.header_budget:
+            return True
+        log.warning('%s header is %d bytes, over the budget of %d bytes%s', header, size, self.header_budget,
+                    ' on page: %s' % (path,) if path else '')
+        return False
+
+    @staticmethod
+    def load_hash_index(path):
+        if not path:
+            return {}
+        try:
+            return load_hash_index(path)
+        except (OSError, ValueError):
+            log.warning('Could not load CSP hash index: %s', path, exc_info=True)
+            return {}
+
+    def get_hashes(self, request, response):
+        hashes = getattr(request, 'csp_hashes', None)
+        if not self.hash_index:
+            return hashes
+
+        templates = getattr(response, 'csp_templates', None) or getattr(response, 'template_name', None)
+        if isinstance(templates, str):
+            templates = (templates,)
+        elif not isinstance(templates, (list, tuple)):
+            return hashes
+
+        for name in templates:
+            if isinstance(name, str) and name in self.hash_index:
+                return merge_hashes(merge_hashes({}, hashes or {}), self.hash_index[name])
+        return hashes
+
+    def add_csp_header(self, request, response, policy, values=None, nonce=None, hashes=None, sample=None):
+        if policy.header in response:
+            return
+        if policy.is_str:
+            response[policy.header] = policy.compiled
+            if sample is not None:
+                sample.record(policy.header, 'precompiled', policy.compiled)
+            return
+
+        update = policy.get_update(response)
+        override = getattr(response, 'csp_override', None)
+        fragment = override.get_fragment(policy) if override is not None else None
+
+        if update is None and nonce is None and not hashes:
+            if policy.compiled is not None:
+                compiled = policy.compiled
+                if fragment is not None:
+                    compiled = self.get_override_header(policy, override, fragment)
+                if compiled:
+                    response[policy.header] = compiled
+                    if sample is not None:
+                        sample.record(policy.header, 'precompiled', compiled)
+                return
+
+            if policy.partial is not None and fragment is None:
+                if sample is not None:
+                    sample.start('compile')
+                try:
+                    compiled = policy.partial.compile(values)
+                except InvalidCSPError as e:
+                    self.log_invalid(request, policy, e)
+                    return
+                finally:
+                    if sample is not None:
+                        sample.stop()
+                if compiled:
+                    self.set_header(request, response, policy, compiled)
+                    if sample is not None:
+                        sample.record(policy.header, 'partial', compiled)
+                return
+
+        if sample is not None:
+            sample.start('merge')
+        # Merging validates directive names as well, so a bad response.csp is logged rather than failing the request.
+        try:
+            csp = policy.resolve(values)
+            if fragment is not None:
+                csp = override.apply(csp, fragment, self.dedupe)
             if update is not None:
                 if update.pop('override', False):
                     csp = update
                 else:
-                    csp = merge_csp_dict(csp, update)
-                break
+                    csp = merge_csp_dict(csp, update, self.dedupe)
+
+            if not csp:
+                return
+
+            if hashes:
+                csp = add_sources_csp_dict(csp, hashes)
 
-        if not csp:
+            if sample is not None:
+                sample.start('compile')
+            if nonce is not None:
+                # Nonces are unique per request, so caching the result would only evict useful entries.
+                compiled = CSPCompiler(add_nonce_csp_dict(csp, nonce, self.nonce_directives),
+                                       **self.compiler_options).compile()
+                status = 'uncached'
+            else:
+                compiled, status = self.cache.compile_status(csp)
+        except InvalidCSPError as e:
+            self.log_invalid(request, policy, e)
             return
+        finally:
+            if sample is not None:
+                sample.stop()
+        self.set_header(request, response, policy, compiled)
+        if sample is not None:
+            sample.record(policy.header, status, compiled)
 
-        try:
-            policy = CSPCompiler(csp).compile()
-        except InvalidCSPError:
-            log.exception('Invalid CSP on page: %s', request.get_full_path())
+    def log_invalid(self, request, policy, error):
+        # A broken callable fails on every request: log each distinct error once, without a traceback.
+        key = (policy.header, str(error))
+        if key in self.logged_errors:
             return
-        response[header] = policy
+        if len(self.logged_errors) < 1000:
+            self.logged_errors.add(key)
+        log.error('Invalid %s on page %s: %s', policy.header, request.get_full_path(), error)
 
-    def process_response(self, request, response):
-        if self.enforced_csp:
-            self.add_csp_header(request, response, 'Content-Security-Policy', self.enforced_csp,
-                                self.enforced_csp_callable, self.enforced_csp_is_str, ('csp',))
-        if self.report_csp:
-            self.add_csp_header(request, response, 'Content-Security-Policy-Report-Only',
-                                self.report_csp, self.report_csp_callable, self.report_csp_is_str,
-                                ('csp_report',) if self.enforced_csp else ('csp_report', 'csp'))
+    def get_override_header(self, policy, override, fragment):
+        compiled = override.headers.get(policy)
+        if compiled is None:
+            # Merged once per decorator and base policy, then reused for every response.
+            compiled = CSPCompiler(override.apply(policy.policy, fragment, self.dedupe),
+                                   **self.compiler_options).compile()
+            self.check_budget(policy.header, compiled)
+            override.headers[policy] = compiled
+        return compiled
+
+    def set_header(self, request, response, policy, compiled):
+        if self.header_budget is not None:
+            self.check_budget(policy.header, compiled, request.get_full_path())
+        response[policy.header] = compiled
+
+    def add_csp_headers(self, request, response, policies, values, sample=None):
+        nonce = get_used_nonce(request)
+        hashes = self.get_hashes(request, response)
+        for policy, policy_values in zip(policies, values):
+            self.add_csp_header(request, response, policy, policy_values, nonce, hashes, sample)
+        if policies:
+            for header, value in self.reporting_headers:
+                if header not in response:
+                    response[header] = value
+        if sample is not None:
+            sample.finish()
+            self.metrics.record(sample)
+        return response
+
+    def get_policies(self, request):
+        policy_set = None
+        if self.router is not None:
+            policy_set = self.router.match(request)
+        if policy_set is None and self.hosts is not None:
+            host = self.get_request_host(request)
+            if host is not None:
+                policy_set = self.hosts.get(host)
+        if policy_set is None:
+            if self.canary is not None and self.canary_sampler.is_sampled(request):
+                return self.canary.policies
+            policy_set = self.default
+        if self.report_sampler is None or self.report_sampler.is_sampled(request):
+            return policy_set.policies
+        return policy_set.unsampled
+
+    @staticmethod
+    def is_exempt(response):
+        override = getattr(response, 'csp_override', None)
+        return override is not None and override.exempt
+
+    def is_bulk_response(self, response):
+        # Streams and files that cannot run script skip evaluation and never have their content read.
+        if not response.streaming or self.streaming_mode == 'full' or hasattr(response, 'csp_override'):
+            return False
+        content_type = response.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        # Browsers sniff a missing type, and any +xml type may hold XHTML or SVG.
+        if not content_type or content_type.endswith('+xml'):
+            return False
+        return content_type not in self.SCRIPTABLE_CONTENT_TYPES
+
+    def add_streaming_header(self, response):
+        if self.streaming_header is not None:
+            for header in self.streaming_headers:
+                if header not in response:
+                    response[header] = self.streaming_header
         return response
 
+    def process_response(self, request, response):
+        if self.is_exempt(response):
+            return response
+        if self.is_bulk_response(response):
+            return self.add_streaming_header(response)
+        sample = ResponseSample() if self.metrics is not None else None
+        if self.refresh_due():
+            self.refresh()
+        policies = self.get_policies(request)
+        if sample is None:
+            return self.add_csp_headers(request, response, policies, [
+                policy.evaluate(request, response) for policy in policies
+            ])
+
+        sample.start('evaluate')
+        values = [policy.evaluate(request, response) for policy in policies]
+        sample.stop()
+        return self.add_csp_headers(request, response, policies, values, sample)
+
+    async def aprocess_response(self, request, response):
+        if self.is_exempt(response):
+            return response
+        if self.is_bulk_response(response):
+            return self.add_streaming_header(response)
+        sample = ResponseSample() if self.metrics is not None else None
+        if self.refresh_due():
+            await sync_to_async(self.refresh)()
+        if self.hosts is not None:
+            # Host policy providers may query the database, which cannot happen in the event loop.
+            host = self.get_request_host(request)
+            if host is not None and not self.hosts.is_fresh(host):
+                await sync_to_async(self.hosts.load)(host)
+        if self.report_sampler is None and self.canary is None:
+            policies = self.get_policies(request)
+        else:
+            # Sampling keys may touch request.user or the session, which can query the database.
+            policies = await sync_to_async(self.get_policies)(request)
+        if sample is not None:
+            sample.start('evaluate')
+        values = await asyncio.gather(*(policy.aevaluate(request, response) for policy in policies))
+        if sample is not None:
+            sample.stop()
+        return self.add_csp_headers(request, response, policies, values, sample)
+
+    def process_request(self, request):
+        request.csp_nonce = lazy_nonce()
+        request.csp_memo = {}
+
     def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        self.process_request(request)
         return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        response = await self.get_response(request)
+        return await self.aprocess_response(request, response)
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-17 12:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CSPViolation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('directive', models.CharField(max_length=64)),
+                ('blocked_uri', models.CharField(max_length=512)),
+                ('document_uri', models.CharField(max_length=512)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('samples', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'verbose_name': 'CSP violation',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='cspviolation',
+            index=models.Index(fields=['-last_seen'], name='csp_advance_last_se_7f7ae8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cspviolation',
+            index=models.Index(fields=['directive', '-last_seen'], name='csp_advance_directi_67cf36_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cspviolation',
+            index=models.Index(fields=['blocked_uri'], name='csp_advance_blocked_e7f9da_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csp_advanced', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CSPPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csp', models.JSONField(blank=True, null=True, verbose_name='enforced policy')),
+                ('csp_report', models.JSONField(blank=True, null=True, verbose_name='report-only policy')),
+                ('comment', models.CharField(blank=True, max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'CSP policy',
+                'verbose_name_plural': 'CSP policies',
+                'get_latest_by': 'pk',
+            },
+        ),
+    ]
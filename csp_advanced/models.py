@@ -1,5 +1,57 @@
 from __future__ import unicode_literals
 
+from django.core.exceptions import ValidationError
 from django.db import models
 
-# Create your models here.
+
+class CSPViolation(models.Model):
+    fingerprint = models.CharField(max_length=64, unique=True)
+    directive = models.CharField(max_length=64)
+    blocked_uri = models.CharField(max_length=512)
+    document_uri = models.CharField(max_length=512)
+    count = models.PositiveBigIntegerField(default=0)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    samples = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        verbose_name = 'CSP violation'
+        indexes = [
+            models.Index(fields=['-last_seen']),
+            models.Index(fields=['directive', '-last_seen']),
+            models.Index(fields=['blocked_uri']),
+        ]
+
+    def __str__(self):
+        return '%s: %s on %s' % (self.directive, self.blocked_uri, self.document_uri)
+
+
+class CSPPolicy(models.Model):
+    csp = models.JSONField(null=True, blank=True, verbose_name='enforced policy')
+    csp_report = models.JSONField(null=True, blank=True, verbose_name='report-only policy')
+    comment = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'CSP policy'
+        verbose_name_plural = 'CSP policies'
+        get_latest_by = 'pk'
+
+    def __str__(self):
+        return 'Policy %s: %s' % (self.pk, self.comment)
+
+    def clean(self):
+        from csp_advanced.csp import CSPCompiler, InvalidCSPError
+        from csp_advanced.policy import Policy
+
+        for field in ('csp', 'csp_report'):
+            value = getattr(self, field)
+            if not value or isinstance(value, str):
+                continue
+            if not isinstance(value, dict):
+                raise ValidationError({field: 'A policy must be a string or an object.'})
+            try:
+                CSPCompiler(Policy.from_dict(value)).compile()
+            except InvalidCSPError as e:
+                raise ValidationError({field: str(e)})
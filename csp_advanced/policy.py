@@ -0,0 +1,127 @@
+import sys
+
+from csp_advanced.csp import CSPCompiler, InvalidCSPError
+from csp_advanced.sources import dedupe_sources
+
+
+def intern_source(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Policy(object):
+    __slots__ = ('values', 'hash', 'compiled')
+
+    # Derived from the compiler's dispatch table, so every directive it compiles has a slot here.
+    DIRECTIVES = (('default-src',) + tuple(sorted(CSPCompiler.CSP_LISTS - {'default-src'})) +
+                  tuple(sorted(CSPCompiler.CSP_BOOLEAN)) +
+                  tuple(sorted(set(CSPCompiler.COMPILERS) - CSPCompiler.CSP_LISTS - CSPCompiler.CSP_BOOLEAN)))
+    INDEX = {name: index for index, name in enumerate(DIRECTIVES)}
+    LIST_DIRECTIVES = CSPCompiler.CSP_LISTS | CSPCompiler.CSP_LIST_SPECIAL
+    EMPTY = (None,) * len(DIRECTIVES)
+
+    def __init__(self, values=EMPTY):
+        object.__setattr__(self, 'values', values)
+        object.__setattr__(self, 'hash', None)
+        object.__setattr__(self, 'compiled', None)
+
+    @classmethod
+    def from_dict(cls, csp):
+        if isinstance(csp, cls):
+            return csp
+        values = list(cls.EMPTY)
+        for name, value in csp.items():
+            values[cls.get_index(name)] = cls.normalize(name, value)
+        return cls(tuple(values))
+
+    @classmethod
+    def get_index(cls, name):
+        try:
+            return cls.INDEX[name]
+        except KeyError:
+            raise InvalidCSPError('Unknown directive: %s' % (name,))
+
+    @classmethod
+    def normalize(cls, name, value):
+        if name not in cls.LIST_DIRECTIVES:
+            return intern_source(value)
+        CSPCompiler.ensure_list(name, value)
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value)
+        return tuple(map(intern_source, value))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Policy objects are immutable')
+
+    def __getitem__(self, name):
+        value = self.values[self.get_index(name)]
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        index = self.INDEX.get(name)
+        if index is None:
+            return default
+        value = self.values[index]
+        return default if value is None else value
+
+    def __contains__(self, name):
+        index = self.INDEX.get(name)
+        return index is not None and self.values[index] is not None
+
+    def items(self):
+        return [(name, value) for name, value in zip(self.DIRECTIVES, self.values) if value is not None]
+
+    def keys(self):
+        return [name for name, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.values) - self.values.count(None)
+
+    def __bool__(self):
+        return self.values != self.EMPTY
+
+    def __eq__(self, other):
+        if not isinstance(other, Policy):
+            return NotImplemented
+        return self.values == other.values
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        if self.hash is None:
+            object.__setattr__(self, 'hash', hash(self.values))
+        return self.hash
+
+    def __repr__(self):
+        return 'Policy(%r)' % (dict(self.items()),)
+
+    def to_dict(self):
+        return {name: list(value) if type(value) is tuple else value for name, value in self.items()}
+
+    def merge(self, update, dedupe=False):
+        if not update:
+            return self
+        # Only the changed directives are rebuilt; every other source tuple is shared with self.
+        values = list(self.values)
+        for name, value in update.items():
+            index = self.get_index(name)
+            value = self.normalize(name, value)
+            orig = values[index]
+            if type(orig) is tuple and type(value) is tuple:
+                values[index] = orig + value
+                if dedupe:
+                    values[index] = tuple(dedupe_sources(name, values[index]))
+            else:
+                values[index] = value
+        return Policy(tuple(values))
+
+    def compile(self):
+        if self.compiled is None:
+            object.__setattr__(self, 'compiled', CSPCompiler(self).compile())
+        return self.compiled
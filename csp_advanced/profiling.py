@@ -0,0 +1,143 @@
+import json
+from collections import defaultdict
+from inspect import isawaitable
+from time import perf_counter
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import Resolver404, resolve
+
+from csp_advanced.middleware import AdvancedCSPMiddleware
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class TimedCallable(object):
+    def __init__(self, func, name, timings):
+        self.func = func
+        self.name = name
+        self.timings = timings
+
+    @property
+    def csp_memo_key(self):
+        return getattr(self.func, 'csp_memo_key', self.func)
+
+    def __call__(self, request, response):
+        start = perf_counter()
+        result = self.func(request, response)
+        if isawaitable(result):
+            return self.atime(result, start)
+        self.timings[self.name].append(perf_counter() - start)
+        return result
+
+    async def atime(self, result, start):
+        result = await result
+        self.timings[self.name].append(perf_counter() - start)
+        return result
+
+
+class ProfileCollector(object):
+    def __init__(self):
+        self.callables = defaultdict(list)
+        self.phases = defaultdict(list)
+        self.sizes = defaultdict(list)
+        self.statuses = defaultdict(int)
+        self.headers = defaultdict(set)
+
+    def record(self, sample):
+        for phase, value in sample.timings.items():
+            self.phases[phase].append(value)
+        self.phases['total'].append(sample.total)
+        for header, size in sample.sizes.items():
+            self.sizes[header].append(size)
+        for key in sample.statuses.items():
+            self.statuses[key] += 1
+
+    def summary(self, requests):
+        def distribution(values, scale=1):
+            return {
+                'count': len(values),
+                'p50': percentile(values, 0.5) * scale,
+                'p90': percentile(values, 0.9) * scale,
+                'p99': percentile(values, 0.99) * scale,
+                'max': max(values) * scale,
+            }
+
+        return {
+            'requests': requests,
+            'callables_ms': {name: distribution(values, 1000) for name, values in sorted(self.callables.items())},
+            'phases_ms': {name: distribution(values, 1000) for name, values in sorted(self.phases.items())},
+            'header_bytes': {name: distribution(values) for name, values in sorted(self.sizes.items())},
+            'distinct_headers': {name: len(values) for name, values in sorted(self.headers.items())},
+            'statuses': {'%s %s' % key: count for key, count in sorted(self.statuses.items())},
+        }
+
+
+class ProfilingMiddleware(AdvancedCSPMiddleware):
+    # Every policy the middleware builds (default, routes, hosts, canary) gets timed callables.
+    def __init__(self, collector):
+        self.collector = collector
+        super().__init__(lambda request: HttpResponse())
+        self.metrics = collector
+
+    def build_policy_set(self, enforced_csp, report_csp, report_attrs):
+        return super().build_policy_set(self.wrap(enforced_csp), self.wrap(report_csp), report_attrs)
+
+    def wrap(self, csp):
+        timings = self.collector.callables
+        if callable(csp):
+            return TimedCallable(csp, '(policy)', timings)
+        if not isinstance(csp, dict):
+            return csp
+        return {name: TimedCallable(value, name, timings) if callable(value) else value
+                for name, value in csp.items()}
+
+
+def load_records(lines):
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError('Line %d: %s' % (number, e))
+        if not isinstance(record, dict) or 'path' not in record:
+            raise ValueError('Line %d: a record must be an object with a path' % (number,))
+        yield record
+
+
+def make_request(factory, record):
+    meta = {'HTTP_%s' % name.upper().replace('-', '_'): value for name, value in record.get('headers', {}).items()}
+    if record.get('host'):
+        meta['HTTP_HOST'] = record['host']
+    request = factory.generic(record.get('method', 'GET'), record['path'], **meta)
+    try:
+        request.resolver_match = resolve(request.path_info)
+    except Resolver404:
+        pass
+    return request
+
+
+def replay(records, repeat=1):
+    collector = ProfileCollector()
+    middleware = ProfilingMiddleware(collector)
+    factory = RequestFactory()
+    requests = 0
+    for record in records:
+        for i in range(repeat):
+            request = make_request(factory, record)
+            response = HttpResponse(status=record.get('status', 200),
+                                    content_type=record.get('content_type', 'text/html; charset=utf-8'))
+            middleware.process_request(request)
+            middleware.process_response(request, response)
+            for header in ('Content-Security-Policy', 'Content-Security-Policy-Report-Only'):
+                if header in response:
+                    collector.headers[header].add(response[header])
+            requests += 1
+    return collector.summary(requests)
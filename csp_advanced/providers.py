@@ -0,0 +1,51 @@
+import uuid
+
+from django.core.cache import caches
+
+
+class CachePolicyProvider(object):
+    def __init__(self, alias='default', key='csp_advanced:policy'):
+        self.alias = alias
+        self.key = key
+        self.version_key = key + ':version'
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get_version(self):
+        return self.cache.get(self.version_key)
+
+    def get_policies(self):
+        data = self.cache.get(self.key)
+        if data is None:
+            return None, None
+        return data.get('csp'), data.get('csp_report')
+
+    def publish(self, csp=None, csp_report=None):
+        version = uuid.uuid4().hex
+        self.cache.set(self.key, {'csp': csp, 'csp_report': csp_report}, None)
+        # The version is written last, so workers never see the new version with the old policy.
+        self.cache.set(self.version_key, version, None)
+        return version
+
+
+class ModelPolicyProvider(object):
+    def get_version(self):
+        from csp_advanced.models import CSPPolicy
+
+        # Only the newest row is read, straight from the index. Its update time catches edits in the admin.
+        return CSPPolicy.objects.order_by('-pk').values_list('pk', 'updated').first()
+
+    def get_policies(self):
+        from csp_advanced.models import CSPPolicy
+
+        policy = CSPPolicy.objects.order_by('-pk').first()
+        if policy is None:
+            return None, None
+        return policy.csp, policy.csp_report
+
+    def publish(self, csp=None, csp_report=None, comment=''):
+        from csp_advanced.models import CSPPolicy
+
+        return CSPPolicy.objects.create(csp=csp, csp_report=csp_report, comment=comment).pk
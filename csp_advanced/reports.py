@@ -0,0 +1,198 @@
+import atexit
+import json
+import logging
+import queue
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+CSP_REPORT_CONTENT_TYPES = {
+    'application/csp-report',
+    'application/reports+json',
+    'application/json',
+}
+
+LEGACY_FIELDS = {
+    'document-uri': 'document_uri',
+    'referrer': 'referrer',
+    'blocked-uri': 'blocked_uri',
+    'violated-directive': 'violated_directive',
+    'effective-directive': 'effective_directive',
+    'original-policy': 'original_policy',
+    'disposition': 'disposition',
+    'source-file': 'source_file',
+    'line-number': 'line_number',
+    'column-number': 'column_number',
+    'status-code': 'status_code',
+    'script-sample': 'sample',
+}
+
+REPORTING_API_FIELDS = {
+    'documentURL': 'document_uri',
+    'referrer': 'referrer',
+    'blockedURL': 'blocked_uri',
+    'effectiveDirective': 'effective_directive',
+    'originalPolicy': 'original_policy',
+    'disposition': 'disposition',
+    'sourceFile': 'source_file',
+    'lineNumber': 'line_number',
+    'columnNumber': 'column_number',
+    'statusCode': 'status_code',
+    'sample': 'sample',
+}
+
+
+REPORTING_ENDPOINT_NAME_RE = re.compile(r'^[a-z*][a-z0-9_.*-]*$')
+
+
+def compile_reporting_endpoints(endpoints):
+    for name, url in endpoints.items():
+        if not REPORTING_ENDPOINT_NAME_RE.match(name):
+            raise ImproperlyConfigured('Invalid reporting endpoint name: %r' % (name,))
+        if '"' in url or '\\' in url:
+            raise ImproperlyConfigured('Invalid reporting endpoint URL: %r' % (url,))
+    return ', '.join('%s="%s"' % (name, url) for name, url in endpoints.items())
+
+
+def compile_report_to(endpoints, max_age):
+    return ', '.join(json.dumps({'group': name, 'max_age': max_age, 'endpoints': [{'url': url}]},
+                                separators=(',', ':')) for name, url in endpoints.items())
+
+
+def normalize_report(data, fields):
+    report = {name: data.get(key) for key, name in fields.items()}
+    if not report['effective_directive'] and report.get('violated_directive'):
+        report['effective_directive'] = report['violated_directive'].split()[0]
+    report.setdefault('violated_directive', report['effective_directive'])
+    report['raw'] = data
+    return report
+
+
+def parse_reports(body):
+    data = json.loads(body.decode('utf-8') if isinstance(body, bytes) else body)
+
+    # The Reporting API sends batches of reports of any type; report-uri sends one csp-report.
+    if isinstance(data, list):
+        return [normalize_report(item['body'], REPORTING_API_FIELDS) for item in data
+                if isinstance(item, dict) and item.get('type') == 'csp-violation' and
+                isinstance(item.get('body'), dict)]
+    if isinstance(data, dict) and isinstance(data.get('csp-report'), dict):
+        return [normalize_report(data['csp-report'], LEGACY_FIELDS)]
+    raise ValueError('Not a CSP report')
+
+
+def log_reports(reports):
+    for report in reports:
+        log.warning('CSP violation of %s: %s blocked on %s', report['effective_directive'],
+                    report['blocked_uri'], report['document_uri'])
+
+
+class ReportQueue(object):
+    def __init__(self, handler, maxsize=10000, batch_size=100, flush_interval=1.0):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+        self.invalid = 0
+
+    def put(self, body):
+        try:
+            self.queue.put_nowait(body)
+        except queue.Full:
+            # Shedding reports is better than blocking web workers during a flood.
+            self.dropped += 1
+            return False
+        self.ensure_worker()
+        return True
+
+    def ensure_worker(self):
+        # Checking is_alive also restarts the worker in processes forked after it started.
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='csp-report-queue', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        # Handlers that buffer reports (such as ViolationStore) are flushed whenever the queue goes idle.
+        idle_timeout = self.flush_interval if hasattr(self.handler, 'flush') else None
+        while True:
+            try:
+                batch = [self.queue.get(timeout=idle_timeout)]
+            except queue.Empty:
+                self.flush()
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.process(batch)
+
+    def process(self, batch):
+        reports = []
+        for body in batch:
+            try:
+                reports.extend(parse_reports(body))
+            except (ValueError, KeyError, TypeError):
+                self.invalid += 1
+        if reports:
+            try:
+                self.handler(reports)
+            except Exception:
+                log.exception('Failed to handle %d CSP reports', len(reports))
+
+    def flush(self):
+        flush = getattr(self.handler, 'flush', None)
+        if flush is not None:
+            try:
+                flush()
+            except Exception:
+                log.exception('Failed to flush CSP reports')
+
+    def drain(self):
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            self.process(batch)
+        self.flush()
+
+
+report_queue = None
+report_queue_lock = threading.Lock()
+
+
+def get_report_queue():
+    global report_queue
+    if report_queue is None:
+        with report_queue_lock:
+            if report_queue is None:
+                handler = getattr(settings, 'ADVANCED_CSP_REPORT_HANDLER', 'csp_advanced.reports.log_reports')
+                report_queue = ReportQueue(
+                    import_string(handler) if isinstance(handler, str) else handler,
+                    maxsize=getattr(settings, 'ADVANCED_CSP_REPORT_QUEUE_SIZE', 10000),
+                    batch_size=getattr(settings, 'ADVANCED_CSP_REPORT_BATCH_SIZE', 100),
+                    flush_interval=getattr(settings, 'ADVANCED_CSP_REPORT_FLUSH_INTERVAL', 1.0),
+                )
+                atexit.register(report_queue.drain)
+    return report_queue
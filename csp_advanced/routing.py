@@ -0,0 +1,55 @@
+class PathTrie(object):
+    def __init__(self):
+        self.root = {}
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def insert(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def longest_prefix(self, path):
+        node = self.root
+        result = node.get(None)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                result = node[None]
+        return result
+
+
+class PolicyRouter(object):
+    # Keys are URL names ('ns:name'), namespaces ('ns:') or path prefixes ('/prefix/').
+    def __init__(self, routes):
+        self.names = {}
+        self.namespaces = {}
+        self.paths = PathTrie()
+        for key, value in routes.items():
+            if key.startswith('/'):
+                self.paths.insert(key, value)
+            elif key.endswith(':'):
+                self.namespaces[key[:-1]] = value
+            else:
+                self.names[key] = value
+
+    def match(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            if self.names:
+                value = self.names.get(match.view_name)
+                if value is not None:
+                    return value
+            if self.namespaces:
+                namespaces = match.namespaces
+                for index in range(len(namespaces), 0, -1):
+                    value = self.namespaces.get(':'.join(namespaces[:index]))
+                    if value is not None:
+                        return value
+        if self.paths:
+            return self.paths.longest_prefix(request.path_info)
+        return None
@@ -0,0 +1,54 @@
+import zlib
+
+BUCKETS = 10000
+
+
+def get_client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def get_session_key(request):
+    session = getattr(request, 'session', None)
+    key = session.session_key if session is not None else None
+    return 'session:%s' % (key,) if key else None
+
+
+def get_user_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'user:%s' % (user.pk,)
+    return get_session_key(request) or 'ip:%s' % (get_client_ip(request),)
+
+
+SAMPLING_KEYS = {
+    'user': get_user_key,
+    'session': lambda request: get_session_key(request) or 'ip:%s' % (get_client_ip(request),),
+    'ip': lambda request: 'ip:%s' % (get_client_ip(request),),
+}
+
+
+class Sampler(object):
+    def __init__(self, rate=1.0, paths=None, key='user', salt=''):
+        self.rate = rate
+        # Longest prefix first, so the most specific path wins.
+        self.paths = sorted((paths or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.key = SAMPLING_KEYS[key] if isinstance(key, str) else key
+        self.salt = salt
+
+    def get_rate(self, path):
+        for prefix, rate in self.paths:
+            if path.startswith(prefix):
+                return rate
+        return self.rate
+
+    def bucket(self, key):
+        return zlib.crc32(('%s:%s' % (self.salt, key)).encode('utf-8')) % BUCKETS
+
+    def is_sampled(self, request):
+        rate = self.get_rate(request.path)
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        # A stable hash of the client key keeps each client in or out of the sample consistently.
+        return self.bucket(self.key(request)) < rate * BUCKETS
@@ -0,0 +1,149 @@
+import re
+from collections import namedtuple
+
+HOST_SOURCE_RE = re.compile(r'^(?:(?P<scheme>[a-z][a-z0-9+.-]*)://)?(?P<host>\*|(?:\*\.)?[a-z0-9-]+(?:\.[a-z0-9-]+)*)'
+                            r'(?::(?P<port>[0-9]+|\*))?(?P<path>/[^;,\s]*)?$', re.IGNORECASE)
+
+# Directives whose values are not source expressions, so wildcards mean nothing there.
+NON_SOURCE_LISTS = {
+    'plugin-types',
+    'require-trusted-types-for',
+    'sandbox',
+    'trusted-types',
+}
+
+# Keywords are stored unquoted. Like nonces and hashes they are case-sensitive and never host sources.
+KEYWORD_SOURCES = {
+    'self',
+    'none',
+    'unsafe-inline',
+    'unsafe-eval',
+    'unsafe-hashes',
+    'wasm-unsafe-eval',
+    'strict-dynamic',
+    'report-sample',
+}
+
+PREFIX_SOURCES = (
+    'nonce-',
+    'sha256-',
+    'sha384-',
+    'sha512-'
+)
+
+DEFAULT_PORTS = {
+    'http': '80',
+    'https': '443',
+    'ws': '80',
+    'wss': '443',
+}
+
+HostSource = namedtuple('HostSource', 'scheme host port path')
+
+
+def parse_host_source(value):
+    # Base64 nonces and hashes may contain a /, which would otherwise parse as a host and a path.
+    if not isinstance(value, str) or value in KEYWORD_SOURCES or value.startswith(PREFIX_SOURCES):
+        return None
+    match = HOST_SOURCE_RE.match(value)
+    if match is None:
+        return None
+    scheme, host, port, path = match.group('scheme', 'host', 'port', 'path')
+    # Any other bare word is not a host that a browser would match either.
+    if scheme is None and port is None and path is None and '.' not in host and host != '*':
+        return None
+    return HostSource(scheme and scheme.lower(), host.lower(), port, path)
+
+
+def wildcard_covers(wildcard, source):
+    if wildcard.port != '*' and wildcard.port != source.port:
+        return False
+    if wildcard.path is not None:
+        if source.path is None:
+            return False
+        if wildcard.path.endswith('/') and not source.path.startswith(wildcard.path):
+            return False
+        if not wildcard.path.endswith('/') and wildcard.path != source.path:
+            return False
+    # A scheme-less source matches the protected resource's scheme, with secure upgrades.
+    if wildcard.scheme == source.scheme:
+        return True
+    if wildcard.scheme is None:
+        return source.scheme == 'https'
+    return wildcard.scheme == 'http' and source.scheme == 'https'
+
+
+def star_covers(source):
+    return source.host != '*' and source.scheme in (None, 'http', 'https')
+
+
+def normalize_sources(values):
+    # dict preserves the order of first appearance while removing duplicates in O(n).
+    sources = list(dict.fromkeys(values))
+    if len(sources) < 2:
+        return sources
+
+    # 'none' is ignored by browsers when combined with other sources.
+    if 'none' in sources:
+        sources.remove('none')
+
+    parsed = [parse_host_source(source) for source in sources]
+    star = '*' in sources
+    wildcards = {}
+    for source in parsed:
+        if source is not None and source.host.startswith('*.'):
+            wildcards.setdefault(source.host[2:], []).append(source)
+    if not star and not wildcards:
+        return sources
+
+    result = []
+    for value, source in zip(sources, parsed):
+        if source is not None and is_covered(source, star, wildcards):
+            continue
+        result.append(value)
+    return result
+
+
+def is_covered(source, star, wildcards):
+    if star and star_covers(source):
+        return True
+    # Check every parent domain, so the cost is proportional to the number of labels.
+    labels = source.host.split('.')
+    for index in range(1, len(labels)):
+        for wildcard in wildcards.get('.'.join(labels[index:]), ()):
+            if wildcard is not source and wildcard_covers(wildcard, source):
+                return True
+    return False
+
+
+def dedupe_sources(name, values):
+    if name in NON_SOURCE_LISTS:
+        return list(dict.fromkeys(values))
+    return normalize_sources(values)
+
+
+def shorten_source(value):
+    source = parse_host_source(value)
+    if source is None:
+        return value
+    port = source.port
+    if port is not None and DEFAULT_PORTS.get(source.scheme) == port:
+        port = None
+    # A lone / matches every path, exactly like having no path at all.
+    path = source.path if source.path != '/' else None
+    return '%s%s%s%s' % (source.scheme + '://' if source.scheme else '', source.host,
+                         ':' + port if port else '', path or '')
+
+
+def covered_by_self(source, origin):
+    if source is None or source.path is not None or source.host != origin.host or source.port != origin.port:
+        return False
+    return source.scheme is None or source.scheme == origin.scheme
+
+
+def minify_sources(values, origin=None):
+    sources = normalize_sources([shorten_source(value) for value in values])
+    if origin is not None and 'self' in sources:
+        origin = parse_host_source(shorten_source(origin))
+        sources = [value for value in sources if not covered_by_self(parse_host_source(value), origin)]
+    return sources
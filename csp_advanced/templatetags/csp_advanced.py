@@ -0,0 +1,36 @@
+from django import template
+from django.conf import settings
+
+from csp_advanced.hashes import cached_hash_source, find_inline_hashes, merge_hashes
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def csp_nonce(context):
+    request = context.get('request')
+    return getattr(request, 'csp_nonce', '')
+
+
+class CSPInlineNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        output = self.nodelist.render(context)
+        request = context.get('request')
+        if request is not None:
+            algorithm = getattr(settings, 'ADVANCED_CSP_HASH_ALGORITHM', 'sha256')
+            hashes = find_inline_hashes(output, algorithm, hasher=cached_hash_source)
+            if hashes:
+                if getattr(request, 'csp_hashes', None) is None:
+                    request.csp_hashes = {}
+                merge_hashes(request.csp_hashes, hashes)
+        return output
+
+
+@register.tag
+def csp_inline(parser, token):
+    nodelist = parser.parse(('endcsp_inline',))
+    parser.delete_first_token()
+    return CSPInlineNode(nodelist)
@@ -1,13 +1,46 @@
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import time
 from collections import OrderedDict
+from io import BytesIO, StringIO
+from unittest import mock
 
-from django.core.exceptions import MiddlewareNotUsed
-from django.http import HttpResponse
-from django.test import RequestFactory, SimpleTestCase, override_settings
+from asgiref.sync import iscoroutinefunction
+from django.core.management import CommandError, call_command
+
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed, ValidationError
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.template import Context, Template
+from django.template.response import TemplateResponse
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import resolve
 from django.utils.decorators import decorator_from_middleware
 
-from csp_advanced.csp import CSPCompiler, InvalidCSPError
+from csp_advanced.cache import CSPCache
+from csp_advanced.checks import check_policies
+from csp_advanced.csp import CSPCompiler, InvalidCSPError, PartialCSPCompiler
+from csp_advanced.decorators import csp_exempt, csp_replace, csp_update
+from csp_advanced.diff import diff_policies, format_diff, parse_csp
+from csp_advanced.hashes import build_hash_index, find_inline_hashes, hash_source
+from csp_advanced.hosts import HostPolicyCache
+from csp_advanced.memo import cache_csp_value
+from csp_advanced.metrics import PrometheusMetrics, ResponseSample, SignalMetrics, csp_response_measured
 from csp_advanced.middleware import AdvancedCSPMiddleware
-from csp_advanced.utils import call_csp_dict, is_callable_csp_dict, merge_csp_dict
+from csp_advanced.models import CSPPolicy, CSPViolation
+from csp_advanced.policy import Policy
+from csp_advanced.providers import CachePolicyProvider, ModelPolicyProvider
+from csp_advanced.reports import ReportQueue, compile_report_to, compile_reporting_endpoints, parse_reports
+from csp_advanced.routing import PolicyRouter
+from csp_advanced.sampling import Sampler
+from csp_advanced.sources import dedupe_sources, normalize_sources
+from csp_advanced.utils import acall_csp_dict, add_nonce_csp_dict, add_sources_csp_dict, call_csp_dict, \
+    get_used_nonce, is_callable_csp_dict, lazy_nonce, merge_csp_dict, merge_csp_fragment, strip_reporting_csp
+from csp_advanced.validation import CheckedCallable, normalize_csp, validate_csp
+from csp_advanced.violations import ViolationStore, violation_fingerprint
 
 
 class CSPCompileTest(SimpleTestCase):
@@ -55,6 +88,37 @@ class CSPCompileTest(SimpleTestCase):
         with self.assertRaises(InvalidCSPError):
             CSPCompiler({'require-sri-for': 'bad'}).compile()
 
+    def test_csp3(self):
+        self.assertEqual(CSPCompiler(OrderedDict([
+            ('script-src-elem', ['self', 'report-sample']),
+            ('script-src-attr', ['unsafe-hashes', 'sha256-abc']),
+            ('style-src-elem', ['self']),
+            ('style-src-attr', ['none']),
+            ('prefetch-src', ['https://dmoj.ca']),
+            ('navigate-to', ['self']),
+            ('script-src', ['wasm-unsafe-eval']),
+            ('trusted-types', ['default', 'dompurify', 'allow-duplicates']),
+            ('require-trusted-types-for', ['script']),
+            ('report-to', 'csp-endpoint'),
+        ])).compile(), "script-src-elem 'self' 'report-sample'; script-src-attr 'unsafe-hashes' 'sha256-abc'; "
+                       "style-src-elem 'self'; style-src-attr 'none'; prefetch-src https://dmoj.ca; "
+                       "navigate-to 'self'; script-src 'wasm-unsafe-eval'; "
+                       "trusted-types default dompurify 'allow-duplicates'; require-trusted-types-for 'script'; "
+                       "report-to csp-endpoint")
+
+        self.assertEqual(CSPCompiler({'trusted-types': ['none']}).compile(), "trusted-types 'none'")
+        for csp in ({'trusted-types': ['bad name']}, {'require-trusted-types-for': ['style']},
+                    {'report-to': ['csp-endpoint']}):
+            with self.assertRaises(InvalidCSPError):
+                CSPCompiler(csp).compile()
+
+    def test_dispatch_table(self):
+        for name in Policy.DIRECTIVES:
+            self.assertIn(name, CSPCompiler.COMPILERS)
+        self.assertEqual(len(Policy.DIRECTIVES), len(CSPCompiler.COMPILERS))
+        self.assertEqual(Policy.from_dict({'trusted-types': {'b', 'a'}})['trusted-types'], ('a', 'b'))
+        self.assertEqual(dedupe_sources('trusted-types', ['*', 'a', 'a']), ['*', 'a'])
+
     def test_upgrade_insecure_requests(self):
         self.assertEqual(CSPCompiler({
             'upgrade-insecure-requests': True,
@@ -80,6 +144,76 @@ class CSPCompileTest(SimpleTestCase):
             "report-uri /dev/null")
 
 
+class CSPMinifyTest(SimpleTestCase):
+    def test_fallback(self):
+        csp = OrderedDict([
+            ('default-src', ['self', 'https://dmoj.ca']),
+            ('script-src', ['https://dmoj.ca', 'self']),
+            ('child-src', ['none']),
+            ('frame-src', ['self', 'https://dmoj.ca']),
+            ('worker-src', ['none']),
+            ('img-src', ['*']),
+        ])
+        compiler = CSPCompiler(csp, minify=True)
+        result = compiler.compile()
+        self.assertEqual(result, "default-src 'self' https://dmoj.ca; child-src 'none'; "
+                                 "frame-src 'self' https://dmoj.ca; img-src *")
+        self.assertEqual(compiler.sizes, (len(CSPCompiler(csp).compile()), len(result)))
+
+    def test_sources(self):
+        self.assertEqual(CSPCompiler({
+            'script-src': ['self', 'HTTPS://DMOJ.CA:443/', 'https://dmoj.ca', 'https://*.dmoj.ca', 'https://a.dmoj.ca'],
+            'img-src': ['http://dmoj.ca:80/img/', 'none', 'data:'],
+            'plugin-types': ['application/pdf'],
+        }, minify=True).compile(), "script-src 'self' https://dmoj.ca https://*.dmoj.ca; "
+                                   "img-src http://dmoj.ca/img/ data:; plugin-types application/pdf")
+
+    def test_self_origin(self):
+        self.assertEqual(CSPCompiler({
+            'script-src': ['self', 'https://dmoj.ca', 'dmoj.ca', 'http://dmoj.ca', 'https://dmoj.ca/js/'],
+            'img-src': ['https://dmoj.ca'],
+        }, minify=True, origin='https://dmoj.ca').compile(),
+            "script-src 'self' http://dmoj.ca https://dmoj.ca/js/; img-src https://dmoj.ca")
+
+    def test_nonce_and_hash(self):
+        self.assertEqual(CSPCompiler({
+            'script-src': ['self', 'nonce-59XGaD3ZnHki/3YFZ1RWrA==', 'sha256-AbC/x+Yz=', 'HTTPS://DMOJ.CA/'],
+        }, minify=True).compile(), "script-src 'self' 'nonce-59XGaD3ZnHki/3YFZ1RWrA==' 'sha256-AbC/x+Yz=' "
+                                   "https://dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self', 'HTTPS://A.COM:443/'],
+                                     'img-src': lambda request, response: ['*', 'https://b.com']},
+                       ADVANCED_CSP_MINIFY=True)
+    def test_partial(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(middleware(RequestFactory().get('/'))['Content-Security-Policy'],
+                         "script-src 'self' https://a.com; img-src *")
+
+    def test_not_minified(self):
+        compiler = CSPCompiler({'script-src': ['self', 'self']})
+        self.assertEqual(compiler.compile(), "script-src 'self' 'self'")
+        self.assertIsNone(compiler.sizes)
+
+
+class PartialCSPCompileTest(SimpleTestCase):
+    def test_partial(self):
+        partial = PartialCSPCompiler(OrderedDict([
+            ('style-src', lambda request, response: [request]),
+            ('script-src', ['self']),
+        ]))
+        self.assertEqual(partial.pieces, [None, "script-src 'self'"])
+        values = partial.evaluate('https://dmoj.ca', None)
+        self.assertEqual(values, {'style-src': ['https://dmoj.ca']})
+        self.assertEqual(partial.compile(values), "style-src https://dmoj.ca; script-src 'self'")
+        self.assertEqual(partial.compile({'style-src': []}), "script-src 'self'")
+
+    def test_partial_invalid(self):
+        with self.assertRaises(InvalidCSPError):
+            PartialCSPCompiler({'script-src': 'self', 'style-src': lambda request, response: []})
+        with self.assertRaises(InvalidCSPError):
+            PartialCSPCompiler({'bad': lambda request, response: []})
+
+
 class CallableCSPDictTest(SimpleTestCase):
     request = object()
     response = object()
@@ -120,6 +254,101 @@ class CallableCSPDictTest(SimpleTestCase):
         self.assertFalse(is_callable_csp_dict({'key': 'value'}))
         self.assertFalse(is_callable_csp_dict(None))
 
+    def test_async_callable_entry(self):
+        async def func(request, response):
+            return request
+
+        self.assertEqual(call_csp_dict({'key': func, 'name': 'mixed'}, 'value', None),
+                         {'key': 'value', 'name': 'mixed'})
+        self.assertEqual(asyncio.run(acall_csp_dict({'key': func, 'other': lambda request, response: 1},
+                                                    'value', None)), {'key': 'value', 'other': 1})
+
+    def test_async_callable(self):
+        async def func(request, response):
+            return {'key': request}
+
+        self.assertEqual(call_csp_dict(func, 'value', None), {'key': 'value'})
+        self.assertEqual(asyncio.run(acall_csp_dict(func, 'value', None)), {'key': 'value'})
+
+    def test_async_concurrent(self):
+        started = []
+
+        async def func(request, response):
+            started.append(1)
+            await asyncio.sleep(0.01)
+            return len(started)
+
+        self.assertEqual(asyncio.run(acall_csp_dict({'a': func, 'b': func}, None, None)), {'a': 2, 'b': 2})
+
+
+class MemoTest(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def sources(self, request, response):
+        self.calls.append(request.path)
+        return ['https://%s' % request.get_host()]
+
+    def test_request_memo(self):
+        with self.settings(ADVANCED_CSP={'script-src': self.sources, 'style-src': self.sources},
+                           ADVANCED_CSP_REPORT_ONLY={'img-src': self.sources}):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        response = middleware(RequestFactory().get('/'))
+        self.assertEqual(response['Content-Security-Policy'], 'script-src https://testserver; '
+                                                              'style-src https://testserver')
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], 'img-src https://testserver')
+        self.assertEqual(self.calls, ['/'])
+        middleware(RequestFactory().get('/a'))
+        self.assertEqual(self.calls, ['/', '/a'])
+
+    def test_request_memo_async(self):
+        async def sources(request, response):
+            self.calls.append(request.path)
+            await asyncio.sleep(0)
+            return ['self']
+
+        async def view(request):
+            return HttpResponse()
+
+        with self.settings(ADVANCED_CSP={'script-src': sources, 'style-src': sources},
+                           ADVANCED_CSP_REPORT_ONLY={'img-src': sources}):
+            middleware = AdvancedCSPMiddleware(view)
+        response = asyncio.run(middleware(RequestFactory().get('/')))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'; style-src 'self'")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "img-src 'self'")
+        self.assertEqual(self.calls, ['/'])
+
+        with self.settings(ADVANCED_CSP={'script-src': sources}, ADVANCED_CSP_REPORT_ONLY={'img-src': sources}):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        response = middleware(RequestFactory().get('/sync'))
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "img-src 'self'")
+        self.assertEqual(self.calls, ['/', '/sync'])
+
+    @override_settings(ALLOWED_HOSTS=['testserver', 'dmoj.ca'])
+    def test_cache_csp_value(self):
+        func = cache_csp_value(lambda request: request.get_host(), timeout=60, maxsize=1)(self.sources)
+        self.assertEqual(func.__name__, 'sources')
+        self.assertEqual(func(RequestFactory().get('/a'), None), ['https://testserver'])
+        self.assertEqual(func(RequestFactory().get('/b'), None), ['https://testserver'])
+        self.assertEqual(self.calls, ['/a'])
+
+        func(RequestFactory().get('/c', HTTP_HOST='dmoj.ca'), None)
+        func(RequestFactory().get('/d'), None)
+        self.assertEqual(self.calls, ['/a', '/c', '/d'])
+
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            func(RequestFactory().get('/e'), None)
+        self.assertEqual(self.calls, ['/a', '/c', '/d', '/e'])
+
+        async def sources(request, response):
+            self.calls.append('async')
+            return ['self']
+
+        func = cache_csp_value(lambda request: 'key')(sources)
+        self.assertEqual(asyncio.run(func(None, None)), ['self'])
+        self.assertEqual(func(None, None), ['self'])
+        self.assertEqual(self.calls.count('async'), 1)
+
 
 class MergeCSPDictTest(SimpleTestCase):
     def test_null(self):
@@ -146,6 +375,759 @@ class MergeCSPDictTest(SimpleTestCase):
         self.assertEqual(merge_csp_dict({'spam': (1,)}, {'spam': (2,)}), {'spam': (1, 2)})
 
 
+class NonceTest(SimpleTestCase):
+    def test_lazy(self):
+        request = RequestFactory().get('/')
+        self.assertIsNone(get_used_nonce(request))
+        request.csp_nonce = lazy_nonce()
+        self.assertIsNone(get_used_nonce(request))
+        nonce = str(request.csp_nonce)
+        self.assertEqual(get_used_nonce(request), nonce)
+        self.assertEqual(len(nonce), 24)
+
+    def test_add_nonce(self):
+        self.assertEqual(add_nonce_csp_dict({'script-src': ['self'], 'style-src': ('self',)},
+                                            'abc', ('script-src', 'style-src')),
+                         {'script-src': ['self', 'nonce-abc'], 'style-src': ('self', 'nonce-abc')})
+
+    def test_add_nonce_default_src(self):
+        self.assertEqual(add_nonce_csp_dict({'default-src': ['self'], 'style-src': ['self']},
+                                            'abc', ('script-src', 'style-src')),
+                         {'default-src': ['self', 'nonce-abc'], 'style-src': ['self', 'nonce-abc']})
+
+    def test_add_nonce_none(self):
+        csp = {'script-src': ['none'], 'img-src': ['self']}
+        self.assertEqual(add_nonce_csp_dict(csp, 'abc', ('script-src', 'style-src')), csp)
+
+    def test_add_nonce_unsafe_inline(self):
+        # A nonce would make browsers ignore 'unsafe-inline' and block inline styles.
+        csp = {'script-src': ['self'], 'style-src': ['self', 'unsafe-inline']}
+        self.assertEqual(add_nonce_csp_dict(csp, 'abc', ('script-src', 'style-src')),
+                         {'script-src': ['self', 'nonce-abc'], 'style-src': ['self', 'unsafe-inline']})
+        self.assertEqual(add_sources_csp_dict(csp, {'style-src': ['sha256-abc']}), csp)
+
+    def test_template_tag(self):
+        request = RequestFactory().get('/')
+        request.csp_nonce = lazy_nonce()
+        self.assertEqual(Template('{% load csp_advanced %}{% csp_nonce %}').render(Context({'request': request})),
+                         get_used_nonce(request))
+
+
+class HashTest(SimpleTestCase):
+    SCRIPT_HASH = 'sha256-bhHHL3z2vDgxUt0W3dWQOrprscmda2Y5pLsLg4GF+pI='
+
+    def write_template(self, directory, name, content):
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_hash_source(self):
+        self.assertEqual(hash_source('alert(1)'), self.SCRIPT_HASH)
+        self.assertTrue(hash_source('alert(1)', 'sha384').startswith('sha384-'))
+
+    def test_find_inline(self):
+        self.assertEqual(find_inline_hashes(
+            '<script>alert(1)</script><script src="/a.js"></script><STYLE media="x">alert(1)</STYLE>'
+        ), {'script-src': [self.SCRIPT_HASH], 'style-src': [self.SCRIPT_HASH]})
+        self.assertEqual(find_inline_hashes('<script>{{ x }}</script>', static_only=True), {})
+
+    def test_build_index(self):
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            self.write_template(first, 'base.html', '<script>alert(1)</script>{% block body %}{% endblock %}')
+            self.write_template(first, 'app/page.html', '{% extends "base.html" %}<style>p{}</style>')
+            self.write_template(second, 'base.html', '<script>alert(2)</script>')
+            self.write_template(second, 'other.html', '<p>no inline</p>')
+            index = build_hash_index([first, second])
+        self.assertEqual(index, {
+            'base.html': {'script-src': [self.SCRIPT_HASH]},
+            'app/page.html': {'style-src': [hash_source('p{}')], 'script-src': [self.SCRIPT_HASH]},
+        })
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_template(directory, 'page.html', '<script>alert(1)</script>')
+            output = os.path.join(directory, 'index.json')
+            with self.settings(TEMPLATES=[{
+                'BACKEND': 'django.template.backends.django.DjangoTemplates', 'DIRS': [directory],
+            }]):
+                call_command('csp_hash_templates', output=output, stdout=StringIO())
+            with open(output) as f:
+                self.assertEqual(json.load(f), {'page.html': {'script-src': [self.SCRIPT_HASH]}})
+
+    def test_template_tag(self):
+        request = RequestFactory().get('/')
+        output = Template('{% load csp_advanced %}{% csp_inline %}<script>{{ code }}</script>{% endcsp_inline %}') \
+            .render(Context({'request': request, 'code': 'alert(1)'}))
+        self.assertEqual(output, '<script>alert(1)</script>')
+        self.assertEqual(request.csp_hashes, {'script-src': [self.SCRIPT_HASH]})
+
+    @override_settings(ADVANCED_CSP={'default-src': ['self'], 'style-src': ['none']})
+    def test_middleware(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.json')
+            with open(path, 'w') as f:
+                json.dump({'page.html': {'script-src': ['sha256-abc'], 'style-src': ['sha256-def']}}, f)
+            with self.settings(ADVANCED_CSP_HASH_INDEX=path):
+                middleware = AdvancedCSPMiddleware(lambda request: TemplateResponse(request, 'page.html'))
+        self.assertEqual(middleware(RequestFactory().get('/'))['Content-Security-Policy'],
+                         "default-src 'self' 'sha256-abc'; style-src 'none'")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']}, ADVANCED_CSP_HASH_INDEX='/nonexistent/index.json')
+    def test_middleware_missing_index(self):
+        with self.assertLogs('csp_advanced.middleware', 'WARNING'):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(middleware.hash_index, {})
+
+
+class ValidationTest(SimpleTestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize_csp({' Script-Src': ["'self'", ' https://dmoj.ca ', 'NONE', "'nonce-abc'"]}),
+                         {'script-src': ['self', 'https://dmoj.ca', 'none', 'nonce-abc']})
+        self.assertEqual(normalize_csp('verbatim'), 'verbatim')
+
+    def test_validate(self):
+        self.assertEqual(validate_csp({
+            'script-src': ['self', '*', 'https:', 'https://*.dmoj.ca:443/path', 'sha256-abc+/=', 'localhost'],
+            'plugin-types': ['application/pdf'],
+            'sandbox': ['allow-scripts'],
+            'upgrade-insecure-requests': True,
+            'style-src': lambda request, response: None,
+        }), [])
+        self.assertEqual(validate_csp({
+            'script-src': ['https://dmoj.ca;', 'nonce-!'],
+            'plugin-types': ['pdf'],
+        }), [
+            "Invalid source expression for script-src: 'https://dmoj.ca;'",
+            "Invalid nonce or hash source for script-src: 'nonce-!'",
+            "Invalid MIME type for plugin-types: 'pdf'",
+        ])
+        self.assertEqual(validate_csp({'bad': ['self'], 'sandbox': ['allow-bad'], 'img-src': 'self'}), [
+            'Unknown directive: bad', 'Unknown sandbox value: allow-bad',
+            'Values for img-src must be list-like type, not str',
+        ])
+
+    @override_settings(ADVANCED_CSP={'script-src': ["'self'"]},
+                       ADVANCED_CSP_ROUTES={'/a/': {'img-src': ['bad source']}})
+    def test_system_check(self):
+        errors = check_policies(None)
+        self.assertEqual([error.id for error in errors], ['csp_advanced.E001'])
+        self.assertEqual(errors[0].obj, "ADVANCED_CSP_ROUTES['/a/']")
+
+    def test_checked_callable(self):
+        func = CheckedCallable(lambda request, response: ['self', 'bad source'], 'img-src')
+        with self.assertLogs('csp_advanced.validation', 'WARNING') as logs:
+            func(None, None)
+        self.assertEqual(len(logs.records), 1)
+        with mock.patch('csp_advanced.validation.validate_directive') as validate:
+            self.assertEqual(func(None, None), ['self', 'bad source'])
+        validate.assert_not_called()
+
+        async def coroutine(request, response):
+            return {'img-src': ['bad source']}
+
+        with self.assertLogs('csp_advanced.validation', 'WARNING'):
+            self.assertEqual(asyncio.run(CheckedCallable(coroutine)(None, None)), {'img-src': ['bad source']})
+
+
+class PolicyTest(SimpleTestCase):
+    def test_from_dict(self):
+        policy = Policy.from_dict(OrderedDict([
+            ('script-src', ['self', 'https://dmoj.ca']),
+            ('default-src', {'self'}),
+            ('upgrade-insecure-requests', True),
+            ('report-uri', '/dev/null'),
+        ]))
+        self.assertEqual(policy['script-src'], ('self', 'https://dmoj.ca'))
+        self.assertEqual(policy.get('img-src', []), [])
+        self.assertIn('default-src', policy)
+        self.assertNotIn('img-src', policy)
+        self.assertNotIn('bad', policy)
+        self.assertEqual(len(policy), 4)
+        self.assertEqual(policy.compile(), "default-src 'self'; script-src 'self' https://dmoj.ca; "
+                                           "upgrade-insecure-requests; report-uri /dev/null")
+        self.assertIs(policy.compile(), policy.compile())
+        self.assertEqual(policy.to_dict(), {
+            'default-src': ['self'], 'script-src': ['self', 'https://dmoj.ca'],
+            'upgrade-insecure-requests': True, 'report-uri': '/dev/null',
+        })
+
+    def test_invalid(self):
+        with self.assertRaises(InvalidCSPError):
+            Policy.from_dict({'bad': ['self']})
+        with self.assertRaises(InvalidCSPError):
+            Policy.from_dict({'script-src': 'self'})
+        with self.assertRaises(InvalidCSPError):
+            Policy.from_dict({'report-uri': ['/dev/null']}).compile()
+
+    def test_hashable(self):
+        first = Policy.from_dict(OrderedDict([('script-src', ['self']), ('img-src', ['*'])]))
+        second = Policy.from_dict(OrderedDict([('img-src', ('*',)), ('script-src', ['self'])]))
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, Policy.from_dict({'script-src': ['self']}))
+        self.assertFalse(Policy())
+        self.assertTrue(first)
+
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            Policy().values = ()
+
+    def test_merge(self):
+        policy = Policy.from_dict({'script-src': ['self'], 'img-src': ['*'], 'report-uri': '/a'})
+        merged = policy.merge({'script-src': ['https://dmoj.ca'], 'style-src': ['self'], 'report-uri': '/b'})
+        self.assertEqual(merged.to_dict(), {
+            'script-src': ['self', 'https://dmoj.ca'], 'img-src': ['*'], 'style-src': ['self'], 'report-uri': '/b',
+        })
+        self.assertIs(merged['img-src'], policy['img-src'])
+        self.assertEqual(policy['script-src'], ('self',))
+        self.assertIs(policy.merge({}), policy)
+        self.assertEqual(merge_csp_dict(policy, {'img-src': ['self']})['img-src'], ('*', 'self'))
+
+
+class CSPCacheTest(SimpleTestCase):
+    def test_canonical_key(self):
+        cache = CSPCache(4)
+        cache.compile(OrderedDict([('script-src', ['self']), ('img-src', ('*',))]))
+        cache.compile(OrderedDict([('img-src', ['*']), ('script-src', ('self',))]))
+        cache.compile(Policy.from_dict({'script-src': ['self'], 'img-src': ['*']}))
+        self.assertEqual(cache.hits, 2)
+
+    def test_hit_miss(self):
+        cache = CSPCache(4)
+        self.assertEqual(cache.compile({'script-src': ['self']}), "script-src 'self'")
+        self.assertEqual(cache.compile({'script-src': ['self']}), "script-src 'self'")
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1, 'maxsize': 4})
+
+    def test_eviction(self):
+        cache = CSPCache(2)
+        cache.compile({'script-src': ['a']})
+        cache.compile({'script-src': ['b']})
+        cache.compile({'script-src': ['a']})
+        cache.compile({'script-src': ['c']})
+        self.assertEqual(cache.evictions, 1)
+        cache.compile({'script-src': ['a']})
+        self.assertEqual(cache.hits, 2)
+        cache.compile({'script-src': ['b']})
+        self.assertEqual(cache.misses, 4)
+
+    def test_disabled(self):
+        cache = CSPCache(0)
+        cache.compile({'script-src': ['self']})
+        cache.compile({'script-src': ['self']})
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalid_not_cached(self):
+        cache = CSPCache(2)
+        for i in range(2):
+            with self.assertRaises(InvalidCSPError):
+                cache.compile({'bad': ['self']})
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class NormalizeSourcesTest(SimpleTestCase):
+    def test_dedupe(self):
+        self.assertEqual(normalize_sources(['self', 'https://dmoj.ca', 'self', 'nonce-1', 'https://dmoj.ca']),
+                         ['self', 'https://dmoj.ca', 'nonce-1'])
+
+    def test_none(self):
+        self.assertEqual(normalize_sources(['none']), ['none'])
+        self.assertEqual(normalize_sources(['none', 'self']), ['self'])
+
+    def test_star(self):
+        self.assertEqual(normalize_sources(['self', 'https://dmoj.ca', '*', 'data:', 'wss://dmoj.ca', 'a.ca:81']),
+                         ['self', '*', 'data:', 'wss://dmoj.ca'])
+
+    def test_star_keeps_nonce_and_hash(self):
+        # * never allows inline scripts, so it cannot cover nonces or hashes, even with a / in the base64.
+        self.assertEqual(normalize_sources(['*', 'nonce-AbC/x+==', 'sha256-AbC/x+=', 'sha256-AbCx+=', 'self']),
+                         ['*', 'nonce-AbC/x+==', 'sha256-AbC/x+=', 'sha256-AbCx+=', 'self'])
+
+    def test_wildcard(self):
+        self.assertEqual(normalize_sources([
+            'https://a.dmoj.ca', '*.dmoj.ca', 'http://b.dmoj.ca', 'c.dmoj.ca:8080', 'dmoj.ca', '*.x.dmoj.ca',
+            'D.DMOJ.CA/path',
+        ]), ['*.dmoj.ca', 'http://b.dmoj.ca', 'c.dmoj.ca:8080', 'dmoj.ca'])
+
+    def test_wildcard_path(self):
+        self.assertEqual(normalize_sources([
+            'https://*.dmoj.ca/static/', 'https://a.dmoj.ca/static/a.js', 'https://a.dmoj.ca/', 'https://b.dmoj.ca:444',
+        ]), ['https://*.dmoj.ca/static/', 'https://a.dmoj.ca/', 'https://b.dmoj.ca:444'])
+        self.assertEqual(normalize_sources(['https://b.dmoj.ca:444', 'https://*.dmoj.ca:*', 'http://c.dmoj.ca']),
+                         ['https://*.dmoj.ca:*', 'http://c.dmoj.ca'])
+
+    def test_non_source(self):
+        self.assertEqual(dedupe_sources('plugin-types', ['application/pdf', 'application/pdf']), ['application/pdf'])
+        self.assertEqual(dedupe_sources('script-src', ['a.ca', '*', 'a.ca']), ['*'])
+
+    def test_merge(self):
+        self.assertEqual(merge_csp_dict({'script-src': ['self', 'https://dmoj.ca']},
+                                        {'script-src': ('https://dmoj.ca', 'none')}, dedupe=True),
+                         {'script-src': ['self', 'https://dmoj.ca']})
+        self.assertEqual(merge_csp_dict({'script-src': ('*',)}, {'script-src': ['https://dmoj.ca']}, dedupe=True),
+                         {'script-src': ('*',)})
+        self.assertEqual(Policy.from_dict({'script-src': ['none']}).merge({'script-src': ['self']}, dedupe=True)
+                         ['script-src'], ('self',))
+
+
+class ReportTest(SimpleTestCase):
+    LEGACY = json.dumps({'csp-report': {
+        'document-uri': 'https://dmoj.ca/',
+        'violated-directive': 'script-src-elem',
+        'blocked-uri': 'https://evil.com/x.js',
+    }}).encode('utf-8')
+    BATCH = json.dumps([
+        {'type': 'csp-violation', 'body': {
+            'documentURL': 'https://dmoj.ca/', 'effectiveDirective': 'img-src', 'blockedURL': 'https://evil.com/',
+        }},
+        {'type': 'deprecation', 'body': {}},
+    ]).encode('utf-8')
+
+    def test_parse_legacy(self):
+        report, = parse_reports(self.LEGACY)
+        self.assertEqual(report['document_uri'], 'https://dmoj.ca/')
+        self.assertEqual(report['effective_directive'], 'script-src-elem')
+        self.assertEqual(report['blocked_uri'], 'https://evil.com/x.js')
+
+    def test_parse_batch(self):
+        report, = parse_reports(self.BATCH)
+        self.assertEqual(report['effective_directive'], 'img-src')
+        self.assertEqual(report['violated_directive'], 'img-src')
+        self.assertEqual(report['blocked_uri'], 'https://evil.com/')
+
+    def test_parse_invalid(self):
+        self.assertRaises(ValueError, parse_reports, b'{}')
+        self.assertRaises(ValueError, parse_reports, b'not json')
+
+    def test_queue(self):
+        handled = []
+        queue = ReportQueue(handled.append, maxsize=3, batch_size=2)
+        with mock.patch.object(queue, 'ensure_worker'):
+            for body in (self.LEGACY, self.BATCH, b'bad', self.LEGACY):
+                queue.put(body)
+        queue.drain()
+        self.assertEqual([len(batch) for batch in handled], [2])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.invalid, 1)
+
+    def test_worker(self):
+        handled = []
+        queue = ReportQueue(handled.append, flush_interval=0.01)
+        queue.put(self.LEGACY)
+        for i in range(100):
+            if handled:
+                break
+            queue.thread.join(0.01)
+        self.assertEqual(len(handled), 1)
+
+    def test_handler_error(self):
+        def handler(reports):
+            raise RuntimeError()
+
+        queue = ReportQueue(handler)
+        with self.assertLogs('csp_advanced.reports', 'ERROR'):
+            queue.process([self.LEGACY])
+
+    def test_view(self):
+        queue = mock.Mock()
+        with mock.patch('csp_advanced.views.get_report_queue', return_value=queue):
+            response = self.client.post('/csp/report/', self.LEGACY, content_type='application/csp-report')
+            self.assertEqual(response.status_code, 204)
+            queue.put.assert_called_once_with(self.LEGACY)
+
+            self.assertEqual(self.client.post('/csp/report/', self.BATCH,
+                                              content_type='application/reports+json').status_code, 204)
+            self.assertEqual(self.client.post('/csp/report/', 'x', content_type='text/plain').status_code, 415)
+            self.assertEqual(self.client.get('/csp/report/').status_code, 405)
+            with self.settings(ADVANCED_CSP_REPORT_MAX_SIZE=10):
+                self.assertEqual(self.client.post('/csp/report/', self.LEGACY,
+                                                  content_type='application/csp-report').status_code, 413)
+            self.assertEqual(queue.put.call_count, 2)
+
+
+class ViolationStoreTest(TestCase):
+    def make_report(self, blocked_uri='https://evil.com/', directive='script-src'):
+        return {'effective_directive': directive, 'blocked_uri': blocked_uri, 'document_uri': 'https://dmoj.ca/',
+                'raw': {'blocked-uri': blocked_uri}}
+
+    def test_aggregate(self):
+        store = ViolationStore(flush_interval=3600, max_samples=2)
+        store([self.make_report()] * 5 + [self.make_report('https://other.com/')])
+        self.assertEqual(CSPViolation.objects.count(), 0)
+        self.assertEqual(len(store.buffer), 2)
+
+        with self.assertNumQueries(6):
+            store.flush()
+        violation = CSPViolation.objects.get(fingerprint=violation_fingerprint(
+            'script-src', 'https://evil.com/', 'https://dmoj.ca/'))
+        self.assertEqual(violation.count, 5)
+        self.assertEqual(violation.samples, [{'blocked-uri': 'https://evil.com/'}] * 2)
+        first_seen = violation.first_seen
+
+        store.add([self.make_report()] * 3 + [self.make_report(directive='img-src')])
+        with self.assertNumQueries(7):
+            store.flush()
+        violation.refresh_from_db()
+        self.assertEqual(violation.count, 8)
+        self.assertEqual(violation.first_seen, first_seen)
+        self.assertEqual(len(violation.samples), 2)
+        self.assertEqual(CSPViolation.objects.count(), 3)
+
+    def test_insert_race(self):
+        store = ViolationStore(flush_interval=3600)
+        store.add([self.make_report()] * 2 + [self.make_report('https://other.com/')])
+        # Another process inserts the same fingerprint between our lookup and our insert.
+        update_existing = store.update_existing
+        calls = []
+
+        def racing_update_existing(buffer, max_samples):
+            calls.append(len(buffer))
+            if len(calls) == 1:
+                ViolationStore(flush_interval=0)([self.make_report()] * 3)
+                return 0
+            return update_existing(buffer, max_samples)
+
+        with mock.patch.object(store, 'update_existing', racing_update_existing):
+            store.flush()
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(CSPViolation.objects.get(blocked_uri='https://evil.com/').count, 5)
+        self.assertEqual(CSPViolation.objects.get(blocked_uri='https://other.com/').count, 1)
+
+    def test_flush_interval(self):
+        store = ViolationStore(flush_interval=0)
+        store([self.make_report()])
+        self.assertEqual(CSPViolation.objects.get().count, 1)
+        store.flush()
+        self.assertEqual(CSPViolation.objects.get().count, 1)
+
+    def test_admin(self):
+        ViolationStore(flush_interval=0)([self.make_report()])
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@dmoj.ca', 'password'))
+        response = self.client.get('/admin/csp_advanced/cspviolation/?q=https://evil')
+        self.assertContains(response, 'https://evil.com/')
+
+
+class HostPolicyTest(SimpleTestCase):
+    calls = []
+
+    @classmethod
+    def host_policies(cls, host):
+        cls.calls.append(host)
+        if host == 'dmoj.ca':
+            return {'img-src': ['https://cdn.dmoj.ca']}, None
+        if host == 'bad.dmoj.ca':
+            return {'bad': ['self']}, None
+        return None
+
+    def setUp(self):
+        self.calls.clear()
+
+    def get_request(self, host):
+        return RequestFactory().get('/', HTTP_HOST=host)
+
+    @override_settings(ALLOWED_HOSTS=['*'], ADVANCED_CSP={'script-src': ['self']},
+                       ADVANCED_CSP_HOST_WARMUP=['dmoj.ca'])
+    def test_host_policies(self):
+        with self.settings(ADVANCED_CSP_HOST_POLICIES=self.host_policies):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(self.calls, ['dmoj.ca'])
+
+        response = middleware(self.get_request('DMOJ.ca'))
+        self.assertEqual(response['Content-Security-Policy'], "img-src https://cdn.dmoj.ca; script-src 'self'")
+        self.assertIs(middleware(self.get_request('dmoj.ca'))['Content-Security-Policy'],
+                      middleware.hosts.get('dmoj.ca').enforced.compiled)
+        self.assertEqual(middleware(self.get_request('other.ca'))['Content-Security-Policy'], "script-src 'self'")
+        with self.assertLogs('csp_advanced.middleware', 'ERROR'):
+            response = middleware(self.get_request('bad.dmoj.ca'))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'")
+        middleware(self.get_request('bad.dmoj.ca'))
+        self.assertEqual(self.calls, ['dmoj.ca', 'other.ca', 'bad.dmoj.ca'])
+
+        async def view(request):
+            return HttpResponse()
+
+        with self.settings(ADVANCED_CSP_HOST_POLICIES=self.host_policies, ADVANCED_CSP_HOST_WARMUP=None):
+            middleware = AdvancedCSPMiddleware(view)
+        response = asyncio.run(middleware(self.get_request('dmoj.ca')))
+        self.assertEqual(response['Content-Security-Policy'], "img-src https://cdn.dmoj.ca; script-src 'self'")
+
+    def test_cache(self):
+        cache = HostPolicyCache(self.host_policies, maxsize=2, ttl=60)
+        cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        cache.get('c')
+        self.assertEqual(list(cache.data), ['a', 'c'])
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertFalse(cache.is_fresh('a'))
+            cache.get('a')
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'a'])
+
+
+class PolicyProviderTest(TestCase):
+    def make_middleware(self, provider):
+        with self.settings(ADVANCED_CSP={'script-src': ['self']}, ADVANCED_CSP_PROVIDER=provider,
+                           ADVANCED_CSP_PROVIDER_INTERVAL=60):
+            return AdvancedCSPMiddleware(lambda request: HttpResponse())
+
+    def get_header(self, middleware):
+        return middleware(RequestFactory().get('/'))['Content-Security-Policy']
+
+    def test_cache_provider(self):
+        provider = CachePolicyProvider(key='test:csp')
+        middleware = self.make_middleware(provider)
+        self.assertEqual(self.get_header(middleware), "script-src 'self'")
+
+        provider.publish({'script-src': ['https://dmoj.ca']})
+        self.assertEqual(self.get_header(middleware), "script-src 'self'")
+        middleware.provider_next_check = 0
+        self.assertEqual(self.get_header(middleware), 'script-src https://dmoj.ca')
+
+        provider.publish({'bad': ['self']})
+        middleware.provider_next_check = 0
+        with self.assertLogs('csp_advanced.middleware', 'ERROR'):
+            self.assertEqual(self.get_header(middleware), 'script-src https://dmoj.ca')
+        provider.cache.delete_many([provider.key, provider.version_key])
+
+    def test_model_provider(self):
+        middleware = self.make_middleware('csp_advanced.providers.ModelPolicyProvider')
+        self.assertIsNone(middleware.provider_version)
+        pk = ModelPolicyProvider().publish(csp_report={'img-src': ['*']})
+
+        middleware.provider_next_check = 0
+        with self.assertNumQueries(2):
+            response = middleware(RequestFactory().get('/'))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], 'img-src *')
+        self.assertEqual(middleware.provider_version, (pk, CSPPolicy.objects.get(pk=pk).updated))
+
+        middleware.provider_next_check = 0
+        with self.assertNumQueries(1):
+            middleware(RequestFactory().get('/'))
+        with self.assertNumQueries(0):
+            middleware(RequestFactory().get('/'))
+
+        # Editing the newest row, as the admin allows, is picked up on the next check.
+        policy = CSPPolicy.objects.get(pk=pk)
+        policy.csp_report = {'img-src': ['https://dmoj.ca']}
+        policy.save()
+        middleware.provider_next_check = 0
+        with self.assertNumQueries(2):
+            response = middleware(RequestFactory().get('/'))
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], 'img-src https://dmoj.ca')
+
+    def test_model_clean(self):
+        CSPPolicy(csp={'script-src': ['self']}).full_clean()
+        with self.assertRaises(ValidationError):
+            CSPPolicy(csp={'bad': ['self']}).full_clean()
+
+
+class MetricsTest(SimpleTestCase):
+    def test_sample(self):
+        sample = ResponseSample()
+        sample.start('merge')
+        sample.start('compile')
+        sample.record('Content-Security-Policy', 'miss', "script-src 'self'")
+        sample.finish()
+        self.assertGreater(sample.timings['merge'], 0)
+        self.assertEqual(sample.timings['evaluate'], 0)
+        self.assertGreaterEqual(sample.total, sample.timings['merge'] + sample.timings['compile'])
+        self.assertEqual(sample.sizes, {'Content-Security-Policy': 17})
+
+    def test_prometheus(self):
+        backend = PrometheusMetrics()
+        with self.settings(ADVANCED_CSP={'script-src': ['self'], 'img-src': lambda request, response: ['*']},
+                           ADVANCED_CSP_REPORT_ONLY={'script-src': ['none']}, ADVANCED_CSP_METRICS=backend):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        middleware(RequestFactory().get('/'))
+        response = HttpResponse()
+        response.csp = {'style-src': ['self']}
+        middleware.process_response(RequestFactory().get('/'), response)
+
+        text = backend.render()
+        self.assertIn('csp_advanced_response_seconds_count{phase="total"} 2', text)
+        self.assertIn('csp_advanced_response_seconds_bucket{phase="evaluate",le="+Inf"} 2', text)
+        self.assertIn('csp_advanced_header_bytes_sum{header="Content-Security-Policy-Report-Only"} 34.0', text)
+        self.assertIn('csp_advanced_headers_total{header="Content-Security-Policy",status="partial"} 1', text)
+        self.assertIn('csp_advanced_headers_total{header="Content-Security-Policy",status="miss"} 1', text)
+        self.assertIn('csp_advanced_headers_total{header="Content-Security-Policy-Report-Only",status="precompiled"} 2',
+                      text)
+
+        auth = {'HTTP_AUTHORIZATION': 'Bearer secret'}
+        with self.settings(ADVANCED_CSP_METRICS=backend, ADVANCED_CSP_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/csp-metrics/', **auth).content.decode('utf-8'), backend.render())
+            self.assertEqual(self.client.get('/csp-metrics/').status_code, 403)
+            self.assertEqual(self.client.get('/csp-metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/csp/metrics/', **auth).status_code, 404)
+        with self.settings(ADVANCED_CSP_METRICS=backend):
+            self.assertEqual(self.client.get('/csp-metrics/', **auth).status_code, 403)
+        with self.settings(ADVANCED_CSP_METRICS=SignalMetrics(), ADVANCED_CSP_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/csp-metrics/', **auth).status_code, 404)
+
+    def test_signal(self):
+        samples = []
+
+        def receiver(sample, **kwargs):
+            samples.append(sample)
+
+        csp_response_measured.connect(receiver)
+        try:
+            with self.settings(ADVANCED_CSP={'script-src': ['self']}, ADVANCED_CSP_METRICS=SignalMetrics()):
+                middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+            middleware(RequestFactory().get('/'))
+        finally:
+            csp_response_measured.disconnect(receiver)
+        self.assertEqual(samples[0].statuses, {'Content-Security-Policy': 'precompiled'})
+
+
+class PolicyDiffTest(SimpleTestCase):
+    def test_parse(self):
+        self.assertEqual(parse_csp("default-src 'self' https://dmoj.ca; upgrade-insecure-requests; "
+                                   "report-uri /r; default-src *; sandbox allow-scripts"), {
+            'default-src': ['self', 'https://dmoj.ca'],
+            'upgrade-insecure-requests': True,
+            'report-uri': '/r',
+            'sandbox': ['allow-scripts'],
+        })
+
+    def test_parse_unknown(self):
+        self.assertEqual(parse_csp("default-src 'self'; fenced-frame-src 'none'"), {'default-src': ['self']})
+
+    @override_settings(ADVANCED_CSP="default-src 'self'; fenced-frame-src 'none'",
+                       ADVANCED_CSP_CANARY={'policy': {'default-src': ['none']}, 'rate': 1})
+    def test_canary_verbatim(self):
+        with self.assertLogs('csp_advanced.middleware', 'INFO'):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(middleware.canary_diff, {'default-src': {'added': ['none'], 'removed': ['self']}})
+        self.assertEqual(middleware(RequestFactory().get('/'))['Content-Security-Policy'],
+                         "default-src 'self'; fenced-frame-src 'none'")
+
+    def test_diff(self):
+        diff = diff_policies(
+            {'script-src': ['self', 'unsafe-inline'], 'img-src': ['*'], 'report-uri': '/a', 'style-src': []},
+            {'script-src': ['self', 'https://dmoj.ca'], 'report-uri': '/b', 'object-src': ['none']},
+        )
+        self.assertEqual(diff, {
+            'img-src': {'added': [], 'removed': ['*']},
+            'object-src': {'added': ['none'], 'removed': []},
+            'script-src': {'added': ['https://dmoj.ca'], 'removed': ['unsafe-inline']},
+            'report-uri': {'old': '/a', 'new': '/b'},
+        })
+        self.assertEqual(format_diff(diff), [
+            'img-src: - *', 'object-src: + none', 'script-src: + https://dmoj.ca', 'script-src: - unsafe-inline',
+            "report-uri: '/a' -> '/b'",
+        ])
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'style-src': lambda request, response: ['self']},
+                       ADVANCED_CSP_CANARY={'policy': {'script-src': ["'none'"]}, 'rate': 0, 'key': 'ip',
+                                            'paths': {'/canary/': 1}})
+    def test_command(self):
+        out = StringIO()
+        call_command('csp_diff', 'ADVANCED_CSP', 'ADVANCED_CSP_CANARY', stdout=out)
+        self.assertEqual(out.getvalue(), 'script-src: + none\nscript-src: - self\n')
+
+        out = StringIO()
+        call_command('csp_diff', '{"img-src": ["*"]}', "img-src 'self'", '--json', stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {'img-src': {'added': ['self'], 'removed': ['*']}})
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('{bad')
+            f.flush()
+            self.assertRaises(CommandError, call_command, 'csp_diff', f.name, 'ADVANCED_CSP')
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']},
+                       ADVANCED_CSP_REPORT_ONLY={'script-src': ['self'], 'img-src': ['self']},
+                       ADVANCED_CSP_CANARY={'policy': {'script-src': ['none']}, 'rate': 0, 'key': 'ip',
+                                            'paths': {'/canary/': 1}})
+    def test_canary(self):
+        with self.assertLogs('csp_advanced.middleware', 'INFO') as logs:
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertIn('script-src: + none', logs.output[-2])
+        self.assertEqual(middleware.canary_diff, {'script-src': {'added': ['none'], 'removed': ['self']}})
+
+        response = middleware(RequestFactory().get('/canary/'))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'")
+        self.assertIs(response['Content-Security-Policy-Report-Only'], middleware.canary.report.compiled)
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'")
+        response = middleware(RequestFactory().get('/'))
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "img-src 'self'; script-src 'self'")
+
+
+class SamplingTest(SimpleTestCase):
+    def make_request(self, path='/', ip='127.0.0.1'):
+        return RequestFactory().get(path, REMOTE_ADDR=ip)
+
+    def test_rate(self):
+        self.assertTrue(Sampler(rate=1).is_sampled(self.make_request()))
+        self.assertFalse(Sampler(rate=0).is_sampled(self.make_request()))
+
+        sampler = Sampler(rate=0.25, key='ip')
+        sampled = [sampler.is_sampled(self.make_request(ip='10.0.%d.%d' % (i // 256, i % 256))) for i in range(2000)]
+        self.assertAlmostEqual(sum(sampled) / len(sampled), 0.25, delta=0.05)
+
+    def test_stable(self):
+        sampler = Sampler(rate=0.5, key='ip')
+        for i in range(20):
+            ip = '10.0.0.%d' % i
+            self.assertEqual(len({sampler.is_sampled(self.make_request(ip=ip)) for j in range(5)}), 1)
+
+    def test_paths(self):
+        sampler = Sampler(rate=0, paths={'/api/': 1, '/api/internal/': 0})
+        self.assertFalse(sampler.is_sampled(self.make_request('/')))
+        self.assertTrue(sampler.is_sampled(self.make_request('/api/users')))
+        self.assertFalse(sampler.is_sampled(self.make_request('/api/internal/x')))
+
+    def test_key(self):
+        self.assertEqual(Sampler().key(self.make_request()), 'ip:127.0.0.1')
+        request = self.make_request()
+        request.user = mock.Mock(is_authenticated=True, pk=5)
+        self.assertEqual(Sampler().key(request), 'user:5')
+        sampler = Sampler(rate=0.5, key=lambda request: request.path)
+        self.assertEqual(sampler.bucket('/a'), sampler.bucket('/a'))
+
+    def test_strip_reporting(self):
+        self.assertEqual(strip_reporting_csp("script-src 'self'; report-uri /a;report-to b"), "script-src 'self'")
+        self.assertEqual(strip_reporting_csp({'script-src': ['self'], 'report-uri': '/a'}), {'script-src': ['self']})
+        self.assertEqual(strip_reporting_csp(lambda request, response: {'report-uri': '/a'})(None, None), {})
+
+
+class RoutingTest(SimpleTestCase):
+    def make_request(self, path):
+        request = RequestFactory().get(path)
+        request.resolver_match = resolve(path)
+        return request
+
+    def test_match(self):
+        router = PolicyRouter({
+            '/': 'root',
+            '/csp/': 'prefix',
+            'csp_advanced:': 'namespace',
+            'csp_advanced:report': 'name',
+        })
+        self.assertEqual(router.match(self.make_request('/csp/report/')), 'name')
+        del router.names['csp_advanced:report']
+        self.assertEqual(router.match(self.make_request('/csp/report/')), 'namespace')
+        router.namespaces.clear()
+        self.assertEqual(router.match(self.make_request('/csp/report/')), 'prefix')
+        self.assertEqual(router.match(RequestFactory().get('/admin/')), 'root')
+
+    def test_longest_prefix(self):
+        router = PolicyRouter({'/a/': 1, '/a/b/': 2, '/a/bc': 3})
+        self.assertEqual(router.match(RequestFactory().get('/a/x')), 1)
+        self.assertEqual(router.match(RequestFactory().get('/a/b/c')), 2)
+        self.assertEqual(router.match(RequestFactory().get('/a/bcd')), 3)
+        self.assertIsNone(router.match(RequestFactory().get('/b/')))
+
+    def test_merge_fragment(self):
+        self.assertEqual(merge_csp_fragment({'script-src': ['self']}, {'script-src': ['https://dmoj.ca']}),
+                         {'script-src': ['self', 'https://dmoj.ca']})
+        self.assertEqual(merge_csp_fragment({'script-src': ['self']}, {'img-src': ['*'], 'override': True}),
+                         {'img-src': ['*']})
+        merged = merge_csp_fragment({'script-src': lambda request, response: ['self']}, {'script-src': ['*']})
+        self.assertEqual(merged['script-src'](None, None), ['self', '*'])
+
+
 class TestMiddleware(SimpleTestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -186,7 +1168,281 @@ class TestMiddleware(SimpleTestCase):
 
     @override_settings(ADVANCED_CSP={'bad': ['self']})
     def test_invalid_csp(self):
-        self.assertFalse('Content-Security-Policy' in self.make_ok_view()(self.get_request()))
+        self.assertRaises(InvalidCSPError, AdvancedCSPMiddleware)
+
+    @override_settings(ADVANCED_CSP={'bad': lambda request, response: ['self']})
+    def test_invalid_callable_directive(self):
+        self.assertRaises(InvalidCSPError, AdvancedCSPMiddleware)
+
+    @override_settings(ADVANCED_CSP={'sandbox': lambda request, response: ['allow-bad']})
+    def test_invalid_callable_csp(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        with self.assertLogs('csp_advanced.middleware', 'ERROR') as logs, \
+                self.assertLogs('csp_advanced.validation', 'WARNING'):
+            for i in range(3):
+                self.assertFalse('Content-Security-Policy' in middleware(self.get_request()))
+        self.assertEqual(len(logs.records), 1)
+        self.assertIsNone(logs.records[0].exc_info)
+
+    @override_settings(ADVANCED_CSP={'Script-Src': ["'self'"]})
+    def test_normalized_csp(self):
+        self.assertEqual(self.make_ok_view()(self.get_request())['Content-Security-Policy'], "script-src 'self'")
+
+    @override_settings(ADVANCED_CSP=OrderedDict([
+        ('script-src', ['self']),
+        ('style-src', lambda request, response: [request.path == '/' and 'self' or 'none']),
+        ('img-src', ['*']),
+        ('frame-src', lambda request, response: []),
+    ]))
+    def test_partial_csp(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse('ok'))
+        self.assertEqual(middleware.enforced.partial.pieces, ["script-src 'self'", None, 'img-src *', None])
+        self.assertEqual(middleware(self.get_request())['Content-Security-Policy'],
+                         "script-src 'self'; style-src 'self'; img-src *")
+        self.assertEqual(middleware(self.factory.get('/other'))['Content-Security-Policy'],
+                         "script-src 'self'; style-src 'none'; img-src *")
+
+    @override_settings(ADVANCED_CSP={'style-src': lambda request, response: ['self']})
+    def test_partial_csp_merge(self):
+        @decorator_from_middleware(AdvancedCSPMiddleware)
+        def view(request):
+            response = HttpResponse()
+            response.csp = {'style-src': ['https://dmoj.ca']}
+            return response
+        self.assertEqual(view(self.get_request())['Content-Security-Policy'], "style-src 'self' https://dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_static_precompiled(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse('ok'))
+        self.assertEqual(middleware.enforced.compiled, "script-src 'self'")
+        self.assertIs(middleware(self.get_request())['Content-Security-Policy'], middleware.enforced.compiled)
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']}, ADVANCED_CSP_CACHE_SIZE=8)
+    def test_merge_cached(self):
+        def view(request):
+            response = HttpResponse()
+            response.csp = {'script-src': ['https://dmoj.ca']}
+            return response
+
+        middleware = AdvancedCSPMiddleware(view)
+        for i in range(3):
+            self.assertEqual(middleware(self.get_request())['Content-Security-Policy'],
+                             "script-src 'self' https://dmoj.ca")
+        self.assertEqual(middleware.cache.hits, 2)
+        self.assertEqual(middleware.cache.misses, 1)
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']},
+                       ADVANCED_CSP_REPORT_ONLY={'style-src': lambda request, response: ['self']})
+    def test_nonce_used(self):
+        def view(request):
+            return HttpResponse(str(request.csp_nonce))
+
+        response = AdvancedCSPMiddleware(view)(self.get_request())
+        nonce = response.content.decode('ascii')
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self' 'nonce-%s'" % nonce)
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "style-src 'self' 'nonce-%s'" % nonce)
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_nonce_unused(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse('ok'))
+        request = self.get_request()
+        self.assertIs(middleware(request)['Content-Security-Policy'], middleware.enforced.compiled)
+        self.assertIsNone(get_used_nonce(request))
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_async(self):
+        async def view(request):
+            return HttpResponse('ok')
+
+        middleware = AdvancedCSPMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertEqual(asyncio.run(middleware(self.get_request()))['Content-Security-Policy'], "script-src 'self'")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_sync(self):
+        self.assertFalse(iscoroutinefunction(AdvancedCSPMiddleware(lambda request: HttpResponse('ok'))))
+
+    @override_settings(ADVANCED_CSP=OrderedDict([
+        ('script-src', ['self']),
+        ('style-src', lambda request, response: ['self']),
+    ]))
+    def test_async_callable(self):
+        async def img_src(request, response):
+            return ['https://dmoj.ca']
+
+        async def view(request):
+            return HttpResponse('ok')
+
+        with self.settings(ADVANCED_CSP_REPORT_ONLY=lambda request, response: {'img-src': ['*']}):
+            self.assertEqual(asyncio.run(AdvancedCSPMiddleware(view)(self.get_request()))
+                             ['Content-Security-Policy-Report-Only'], 'img-src *')
+
+        with self.settings(ADVANCED_CSP={'style-src': ['self'], 'img-src': img_src}):
+            response = asyncio.run(AdvancedCSPMiddleware(view)(self.get_request()))
+            self.assertEqual(response['Content-Security-Policy'], "style-src 'self'; img-src https://dmoj.ca")
+            response = AdvancedCSPMiddleware(lambda request: HttpResponse('ok'))(self.get_request())
+            self.assertEqual(response['Content-Security-Policy'], "style-src 'self'; img-src https://dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self', 'https://dmoj.ca']}, ADVANCED_CSP_DEDUPE=True)
+    def test_merge_dedupe(self):
+        def view(request):
+            response = HttpResponse()
+            response.csp = {'script-src': ['https://dmoj.ca', 'self', 'https://cdn.dmoj.ca']}
+            return response
+        self.assertEqual(AdvancedCSPMiddleware(view)(self.get_request())['Content-Security-Policy'],
+                         "script-src 'self' https://dmoj.ca https://cdn.dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'default-src': ['self'], 'script-src': ['self', 'self']}, ADVANCED_CSP_MINIFY=True)
+    def test_minify(self):
+        with self.assertLogs('csp_advanced.middleware', 'INFO'):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(middleware.enforced.sizes, (44, 18))
+        self.assertEqual(middleware(self.get_request())['Content-Security-Policy'], "default-src 'self'")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']}, ADVANCED_CSP_HEADER_BUDGET=10)
+    def test_budget(self):
+        with self.assertLogs('csp_advanced.middleware', 'WARNING'):
+            AdvancedCSPMiddleware(lambda request: HttpResponse())
+        with self.settings(ADVANCED_CSP_HEADER_BUDGET_STRICT=True), \
+                self.assertLogs('csp_advanced.middleware', 'WARNING'):
+            self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+        with self.settings(ADVANCED_CSP_HEADER_BUDGET=20):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+
+        response = HttpResponse()
+        response.csp = {'script-src': ['https://dmoj.ca']}
+        with self.assertLogs('csp_advanced.middleware', 'WARNING'):
+            middleware.process_response(self.get_request(), response)
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self' https://dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']},
+                       ADVANCED_CSP_REPORT_ONLY={'script-src': ['none'], 'report-uri': '/report'},
+                       ADVANCED_CSP_REPORT_ONLY_SAMPLING={'rate': 0, 'paths': {'/sampled/': 1}})
+    def test_report_sampling(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        response = middleware(self.factory.get('/'))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'")
+        self.assertNotIn('Content-Security-Policy-Report-Only', response)
+        response = middleware(self.factory.get('/sampled/'))
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'; report-uri /report")
+
+        with self.settings(ADVANCED_CSP_REPORT_ONLY_SAMPLING={'rate': 0, 'mode': 'reporting'}):
+            middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        self.assertEqual(middleware(self.get_request())['Content-Security-Policy-Report-Only'], "script-src 'none'")
+
+        with self.settings(ADVANCED_CSP_REPORT_ONLY_SAMPLING={'mode': 'bad'}):
+            self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+
+    @override_settings(ADVANCED_CSP_REPORT_ONLY={'script-src': ['none']},
+                       ADVANCED_CSP_REPORT_ONLY_SAMPLING={'rate': 0})
+    def test_report_sampling_async(self):
+        async def view(request):
+            return HttpResponse('ok')
+
+        self.assertNotIn('Content-Security-Policy-Report-Only',
+                         asyncio.run(AdvancedCSPMiddleware(view)(self.get_request())))
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']},
+                       ADVANCED_CSP_REPORT_ONLY={'script-src': ['none']},
+                       ADVANCED_CSP_ROUTES={
+                           'csp_advanced:': {'script-src': ['https://dmoj.ca']},
+                           '/admin/': {'default-src': ['self'], 'override': True},
+                       },
+                       ADVANCED_CSP_REPORT_ONLY_ROUTES={'/admin/': {'img-src': ['*']}})
+    def test_routes(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        request = self.factory.get('/csp/report/')
+        request.resolver_match = resolve('/csp/report/')
+        response = middleware(request)
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self' https://dmoj.ca")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'")
+
+        response = middleware(self.factory.get('/admin/login/'))
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'self'")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "img-src *; script-src 'none'")
+
+        response = middleware(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'")
+
+    @override_settings(ADVANCED_CSP='verbatim bad csp', ADVANCED_CSP_ROUTES={'/admin/': {'img-src': ['*']}})
+    def test_routes_str_base(self):
+        self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'img-src': ['self']},
+                       ADVANCED_CSP_REPORT_ONLY={'script-src': ['none']})
+    def test_decorators(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+
+        @csp_update({'script-src': ['https://dmoj.ca']}, csp_report={'img-src': ['*']})
+        def update(request):
+            return HttpResponse()
+
+        @csp_replace({'script-src': ['https://dmoj.ca']})
+        def replace(request):
+            return HttpResponse()
+
+        @csp_exempt
+        def exempt(request):
+            return HttpResponse()
+
+        response = middleware.process_response(self.get_request(), update(self.get_request()))
+        self.assertEqual(response['Content-Security-Policy'], "img-src 'self'; script-src 'self' https://dmoj.ca")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "img-src *; script-src 'none'")
+        second = middleware.process_response(self.get_request(), update(self.get_request()))
+        self.assertIs(second['Content-Security-Policy'], response['Content-Security-Policy'])
+
+        override = second.csp_override
+        self.assertEqual(len(override.headers), 2)
+        middleware.load_policies(middleware.enforced_csp, middleware.report_csp)
+        gc.collect()
+        self.assertEqual(len(override.headers), 0)
+
+        response = middleware.process_response(self.get_request(), replace(self.get_request()))
+        self.assertEqual(response['Content-Security-Policy'], "img-src 'self'; script-src https://dmoj.ca")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'")
+
+        response = middleware.process_response(self.get_request(), exempt(self.get_request()))
+        self.assertNotIn('Content-Security-Policy', response)
+        self.assertNotIn('Content-Security-Policy-Report-Only', response)
+
+        self.assertRaises(InvalidCSPError, csp_update, {'bad': ['self']})
+
+    @override_settings(ADVANCED_CSP={'script-src': lambda request, response: ['self']})
+    def test_decorators_callable(self):
+        @csp_update({'script-src': ['https://dmoj.ca']})
+        async def view(request):
+            return HttpResponse()
+
+        response = asyncio.run(AdvancedCSPMiddleware(view)(self.get_request()))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self' https://dmoj.ca")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'report-to': 'csp'},
+                       ADVANCED_CSP_REPORTING_ENDPOINTS={'csp': '/csp/report/', 'other': 'https://dmoj.ca/r'},
+                       ADVANCED_CSP_REPORT_TO_HEADER=True, ADVANCED_CSP_REPORT_TO_MAX_AGE=60)
+    def test_reporting_endpoints(self):
+        middleware = AdvancedCSPMiddleware(lambda request: HttpResponse())
+        response = middleware(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'; report-to csp")
+        self.assertEqual(response['Reporting-Endpoints'], 'csp="/csp/report/", other="https://dmoj.ca/r"')
+        self.assertEqual([json.loads('[%s]' % response['Report-To'])[0]], [
+            {'group': 'csp', 'max_age': 60, 'endpoints': [{'url': '/csp/report/'}]},
+        ])
+        self.assertIs(middleware(self.get_request())['Reporting-Endpoints'], middleware.reporting_headers[0][1])
+
+        with self.settings(ADVANCED_CSP={'report-to': 'missing'}):
+            self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+            self.assertEqual([error.id for error in check_policies(None)], ['csp_advanced.E002'])
+
+    def test_compile_reporting_endpoints(self):
+        self.assertEqual(compile_report_to({'a': '/r'}, 10), '{"group":"a","max_age":10,"endpoints":[{"url":"/r"}]}')
+        self.assertRaises(ImproperlyConfigured, compile_reporting_endpoints, {'Bad Name': '/r'})
+        self.assertRaises(ImproperlyConfigured, compile_reporting_endpoints, {'a': '/r"'})
+
+    @override_settings(ADVANCED_CSP='verbatim bad csp', ADVANCED_CSP_REPORT_ONLY={'script-src': ['self']})
+    def test_setting_str_and_dict(self):
+        response = self.make_ok_view()(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], 'verbatim bad csp')
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'self'")
 
     @override_settings(ADVANCED_CSP_REPORT_ONLY={'default-src': ['http://dmoj.ca']})
     def test_setting_csp_report(self):
@@ -259,6 +1515,18 @@ class TestMiddleware(SimpleTestCase):
         self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'")
         self.assertFalse('Content-Security-Policy' in response)
 
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_invalid_update(self):
+        def view(request):
+            response = HttpResponse()
+            response.csp = {'bad-directive': ['self']}
+            return response
+
+        with self.assertLogs('csp_advanced.middleware', 'ERROR') as logs:
+            response = AdvancedCSPMiddleware(view)(self.get_request())
+        self.assertNotIn('Content-Security-Policy', response)
+        self.assertIn('Unknown directive: bad-directive', logs.output[0])
+
     @override_settings(ADVANCED_CSP_REPORT_ONLY={'script-src': ['self']})
     def test_override_csp_report_only_explicit(self):
         @decorator_from_middleware(AdvancedCSPMiddleware)
@@ -270,3 +1538,131 @@ class TestMiddleware(SimpleTestCase):
         response = view(self.get_request())
         self.assertEqual(response['Content-Security-Policy-Report-Only'], "script-src 'none'")
         self.assertFalse('Content-Security-Policy' in response)
+
+    img_src = mock.Mock(return_value=['*'])
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'img-src': img_src},
+                       ADVANCED_CSP_REPORT_ONLY={'style-src': ['self']})
+    def test_streaming(self):
+        self.img_src.reset_mock()
+        consumed = []
+
+        def content():
+            consumed.append(True)
+            yield b'a,b\n'
+
+        middleware = AdvancedCSPMiddleware(lambda request: FileResponse(BytesIO(b'%PDF'), filename='a.pdf'))
+        response = middleware(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'none'")
+        self.assertEqual(response['Content-Security-Policy-Report-Only'], "default-src 'none'")
+
+        with self.settings(ADVANCED_CSP=None):
+            middleware = AdvancedCSPMiddleware(lambda request: FileResponse(BytesIO(b'%PDF'), filename='a.pdf'))
+            response = middleware(self.get_request())
+            self.assertNotIn('Content-Security-Policy', response)
+            self.assertEqual(response['Content-Security-Policy-Report-Only'], "default-src 'none'")
+
+        middleware = AdvancedCSPMiddleware(lambda request: StreamingHttpResponse(content(), content_type='text/csv'))
+        response = middleware(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'none'")
+        self.assertEqual(consumed, [])
+        self.img_src.assert_not_called()
+
+        # Streamed documents that can run script still get the full policy.
+        for content_type in ('text/html', 'image/svg+xml', 'application/xml', 'text/xml', 'application/atom+xml'):
+            middleware = AdvancedCSPMiddleware(
+                lambda request: StreamingHttpResponse(content(), content_type=content_type + '; charset=utf-8'))
+            response = middleware(self.get_request())
+            self.assertEqual(response['Content-Security-Policy'], "script-src 'self'; img-src *")
+        with self.settings(ADVANCED_CSP_STREAMING='skip'):
+            middleware = AdvancedCSPMiddleware(lambda request: FileResponse(BytesIO(b'<svg/>'), filename='a.svg'))
+            self.assertEqual(middleware(self.get_request())['Content-Security-Policy'],
+                             "script-src 'self'; img-src *")
+        self.assertEqual(consumed, [])
+
+        async def view(request):
+            return StreamingHttpResponse(content(), content_type='application/json')
+
+        response = asyncio.run(AdvancedCSPMiddleware(view)(self.get_request()))
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'none'")
+
+        with self.settings(ADVANCED_CSP_STREAMING='skip'):
+            response = AdvancedCSPMiddleware(view)
+            self.assertNotIn('Content-Security-Policy', asyncio.run(response(self.get_request())))
+
+        with self.settings(ADVANCED_CSP_STREAMING_POLICY="sandbox"):
+            middleware = AdvancedCSPMiddleware(lambda request: FileResponse(BytesIO(b'%PDF'), filename='a.pdf'))
+            self.assertEqual(middleware(self.get_request())['Content-Security-Policy'], 'sandbox')
+
+        with self.settings(ADVANCED_CSP_STREAMING='full'):
+            middleware = AdvancedCSPMiddleware(lambda request: FileResponse(BytesIO(b'%PDF'), filename='a.pdf'))
+            self.assertEqual(middleware(self.get_request())['Content-Security-Policy'],
+                             "script-src 'self'; img-src *")
+
+        @csp_update({'img-src': ['https://dmoj.ca']})
+        def decorated(request):
+            return StreamingHttpResponse(content(), content_type='text/csv')
+
+        response = AdvancedCSPMiddleware(decorated)(self.get_request())
+        self.assertEqual(response['Content-Security-Policy'], "img-src * https://dmoj.ca; script-src 'self'")
+
+    @override_settings(ADVANCED_CSP={'script-src': ['self']})
+    def test_streaming_invalid(self):
+        with self.settings(ADVANCED_CSP_STREAMING='never'):
+            self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+        with self.settings(ADVANCED_CSP_STREAMING_POLICY={'img-src': lambda request, response: ['*']}):
+            self.assertRaises(ImproperlyConfigured, AdvancedCSPMiddleware)
+
+
+class AsyncMiddlewareTest(TestCase):
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'img-src': lambda request, response: [
+        'https://%s.dmoj.ca' % User.objects.count()]})
+    def test_sync_callable_uses_orm(self):
+        async def view(request):
+            return HttpResponse('ok')
+
+        # Synchronous callables run in a thread, so the ORM does not raise SynchronousOnlyOperation.
+        response = asyncio.run(AdvancedCSPMiddleware(view)(RequestFactory().get('/')))
+        self.assertEqual(response['Content-Security-Policy'], "script-src 'self'; img-src https://0.dmoj.ca")
+
+
+class ProfileCommandTest(SimpleTestCase):
+    @override_settings(ADVANCED_CSP={'script-src': ['self'], 'img-src': lambda request, response: [
+                           request.META.get('HTTP_X_CDN', 'self')]},
+                       ADVANCED_CSP_REPORT_ONLY={'style-src': lambda request, response: ['self']},
+                       ALLOWED_HOSTS=['dmoj.ca'])
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"path": "/", "host": "dmoj.ca"}\n\n')
+            f.write('{"path": "/problems/", "host": "dmoj.ca", "headers": {"X-CDN": "https://cdn.dmoj.ca"}}\n')
+            f.flush()
+
+            out = StringIO()
+            call_command('csp_profile', f.name, '--repeat', '2', '--json', stdout=out)
+            report = json.loads(out.getvalue())
+            self.assertEqual(report['requests'], 4)
+            self.assertEqual(sorted(report['callables_ms']), ['img-src', 'style-src'])
+            self.assertEqual(report['callables_ms']['img-src']['count'], 4)
+            self.assertEqual(report['phases_ms']['compile']['count'], 4)
+            self.assertEqual(report['header_bytes']['Content-Security-Policy']['max'],
+                             len("img-src https://cdn.dmoj.ca; script-src 'self'"))
+            self.assertEqual(report['distinct_headers'], {
+                'Content-Security-Policy': 2, 'Content-Security-Policy-Report-Only': 1,
+            })
+
+            out = StringIO()
+            call_command('csp_profile', f.name, stdout=out)
+            self.assertIn('Replayed 2 requests', out.getvalue())
+            self.assertIn('Callable latency (ms)', out.getvalue())
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"host": "dmoj.ca"}\n')
+            f.flush()
+            self.assertRaises(CommandError, call_command, 'csp_profile', f.name)
+
+    @override_settings(ADVANCED_CSP=None, ADVANCED_CSP_REPORT_ONLY=None)
+    def test_no_policy(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"path": "/"}\n')
+            f.flush()
+            self.assertRaises(CommandError, call_command, 'csp_profile', f.name)
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from csp_advanced import views
+
+app_name = 'csp_advanced'
+
+urlpatterns = [
+    path('report/', views.report, name='report'),
+]
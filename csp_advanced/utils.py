@@ -1,3 +1,16 @@
+import asyncio
+import base64
+import os
+from functools import partial
+from inspect import isawaitable
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.utils.functional import SimpleLazyObject, empty
+
+from csp_advanced.memo import call_csp_value
+from csp_advanced.sources import dedupe_sources
+
+
 def is_callable_csp_dict(data):
     if callable(data):
         return True
@@ -6,32 +19,163 @@ def is_callable_csp_dict(data):
     return any(callable(value) for value in data.values())
 
 
+async def await_value(value):
+    return await value
+
+
+async def gather_csp_values(values):
+    pending = [(key, value) for key, value in values.items() if isawaitable(value)]
+    if pending:
+        results = await asyncio.gather(*(value for key, value in pending))
+        for (key, _), result in zip(pending, results):
+            values[key] = result
+    return values
+
+
+def is_async_csp_value(func):
+    # Wrappers such as CheckedCallable and cache_csp_value keep the wrapped function as .func.
+    while not iscoroutinefunction(func) and hasattr(func, 'func'):
+        func = func.func
+    return iscoroutinefunction(func)
+
+
+def is_async_csp_dict(data):
+    if callable(data):
+        return is_async_csp_value(data)
+    return all(is_async_csp_value(value) for value in data.values() if callable(value))
+
+
+def call_csp_values(data, request, response):
+    if callable(data):
+        return call_csp_value(data, request, response)
+    return {key: call_csp_value(value, request, response) if callable(value) else value
+            for key, value in data.items()}
+
+
 def call_csp_dict(data, request, response):
+    result = call_csp_values(data, request, response)
     if callable(data):
-        return data(request, response)
+        return async_to_sync(await_value)(result) if isawaitable(result) else result
 
-    result = {}
-    for key, value in data.items():
-        if callable(value):
-            result[key] = value(request, response)
-        else:
-            result[key] = value
+    if any(isawaitable(value) for value in result.values()):
+        return async_to_sync(gather_csp_values)(result)
     return result
 
 
-def merge_csp_dict(template, override):
+async def acall_csp_dict(data, request, response):
+    if is_async_csp_dict(data):
+        result = call_csp_values(data, request, response)
+    else:
+        # Synchronous callables may use the ORM or block, so they run in a thread, as under sync middleware.
+        result = await sync_to_async(call_csp_values, thread_sensitive=True)(data, request, response)
+
+    if callable(data):
+        return await result if isawaitable(result) else result
+    # Awaitables from async callables run concurrently.
+    return await gather_csp_values(result)
+
+
+def merge_csp_value(orig, value):
+    if isinstance(orig, list):
+        return orig + list(value)
+    elif isinstance(orig, set):
+        return orig.union(value)
+    elif isinstance(orig, tuple):
+        return orig + tuple(value)
+    return value
+
+
+def merge_csp_dict(template, override, dedupe=False):
+    if not isinstance(template, dict):
+        # Policy objects merge with structural sharing.
+        return template.merge(override, dedupe)
+
     result = template.copy()
     for key, value in override.items():
         if key not in result:
             result[key] = value
             continue
         orig = result[key]
-        if isinstance(orig, list):
-            result[key] = orig + list(value)
-        elif isinstance(orig, set):
-            result[key] = orig.union(value)
-        elif isinstance(orig, tuple):
-            result[key] = orig + tuple(value)
-        else:
+        result[key] = merge_csp_value(orig, value)
+        if dedupe and isinstance(orig, (list, tuple)):
+            result[key] = type(orig)(dedupe_sources(key, result[key]))
+    return result
+
+
+def map_csp_result(func, transform):
+    def wrapper(request, response):
+        result = func(request, response)
+        if isawaitable(result):
+            async def transform_async():
+                return transform(await result)
+            return transform_async()
+        return transform(result)
+    return wrapper
+
+
+def merge_csp_fragment(base, fragment):
+    fragment = dict(fragment)
+    if fragment.pop('override', False):
+        return fragment
+    if callable(base):
+        return map_csp_result(base, partial(merge_csp_dict, override=fragment))
+
+    result = dict(base)
+    for key, value in fragment.items():
+        orig = result.get(key)
+        if callable(orig):
+            result[key] = map_csp_result(orig, partial(merge_csp_value, value=value))
+        elif orig is None:
             result[key] = value
+        else:
+            result[key] = merge_csp_value(orig, value)
     return result
+
+
+REPORTING_DIRECTIVES = ('report-uri', 'report-to')
+
+
+def strip_reporting_csp(csp):
+    if isinstance(csp, str):
+        pieces = (piece.strip() for piece in csp.split(';'))
+        return '; '.join(piece for piece in pieces if piece and piece.split()[0] not in REPORTING_DIRECTIVES)
+
+    if callable(csp):
+        return map_csp_result(csp, strip_reporting_csp)
+
+    return {key: value for key, value in csp.items() if key not in REPORTING_DIRECTIVES}
+
+
+def generate_nonce():
+    return base64.b64encode(os.urandom(16)).decode('ascii')
+
+
+def lazy_nonce():
+    return SimpleLazyObject(generate_nonce)
+
+
+def get_used_nonce(request):
+    nonce = getattr(request, 'csp_nonce', None)
+    if nonce is None or (isinstance(nonce, SimpleLazyObject) and nonce._wrapped is empty):
+        return None
+    return str(nonce)
+
+
+def add_sources_csp_dict(csp, sources):
+    update = {}
+    for directive, values in sources.items():
+        # Directives that are absent fall back to default-src, so the sources have to go there.
+        target = directive if directive in csp else 'default-src'
+        value = csp.get(target)
+        # Browsers ignore 'unsafe-inline' next to a nonce or hash, which would block every other inline element.
+        if not value or 'none' in value or 'unsafe-inline' in value:
+            continue
+        added = update.setdefault(target, [])
+        added.extend(source for source in values if source not in added and source not in value)
+    update = {key: value for key, value in update.items() if value}
+    return merge_csp_dict(csp, update) if update else csp
+
+
+def add_nonce_csp_dict(csp, nonce, directives):
+    source = 'nonce-%s' % (nonce,)
+    return add_sources_csp_dict(csp, {directive: [source] for directive in directives})
@@ -0,0 +1,128 @@
+import logging
+import re
+from inspect import isawaitable
+
+from csp_advanced.csp import CSPCompiler, InvalidCSPError
+from csp_advanced.sources import HOST_SOURCE_RE, NON_SOURCE_LISTS
+
+log = logging.getLogger(__name__)
+
+SCHEME_SOURCE_RE = re.compile(r'^[a-z][a-z0-9+.-]*:$', re.IGNORECASE)
+HASH_SOURCE_RE = re.compile(r'^(?:nonce|sha256|sha384|sha512)-[A-Za-z0-9+/_-]+={0,2}$')
+MIME_TYPE_RE = re.compile(r'^[a-z0-9!#$&^_.+-]+/[a-z0-9!#$&^_.+-]+$', re.IGNORECASE)
+
+
+def normalize_source(value):
+    if not isinstance(value, str):
+        return value
+    value = value.strip()
+    # Keywords are written unquoted in policy dicts; quoting them would produce ''self''.
+    if len(value) > 2 and value[0] == value[-1] == "'":
+        keyword = value[1:-1]
+        if keyword.lower() in CSPCompiler.CSP_FETCH_SPECIAL:
+            return keyword.lower()
+        if keyword.startswith(CSPCompiler.CSP_PREFIX_SPECIAL):
+            return keyword
+    elif value.lower() in CSPCompiler.CSP_FETCH_SPECIAL:
+        return value.lower()
+    return value
+
+
+def normalize_csp(csp):
+    if not isinstance(csp, dict):
+        return csp
+    result = {}
+    for name, value in csp.items():
+        if isinstance(name, str):
+            name = name.strip().lower()
+        if isinstance(value, (list, tuple)):
+            value = [normalize_source(item) for item in value]
+        elif isinstance(value, (set, frozenset)):
+            value = {normalize_source(item) for item in value}
+        result[name] = value
+    return result
+
+
+def validate_source(name, value):
+    if not isinstance(value, str):
+        return 'Source for %s must be a string, not %s' % (name, type(value).__name__)
+    if name == 'plugin-types':
+        if not MIME_TYPE_RE.match(value):
+            return 'Invalid MIME type for plugin-types: %r' % (value,)
+        return None
+    if value in CSPCompiler.CSP_FETCH_SPECIAL or value == '*':
+        return None
+    if value.startswith(CSPCompiler.CSP_PREFIX_SPECIAL):
+        if not HASH_SOURCE_RE.match(value):
+            return 'Invalid nonce or hash source for %s: %r' % (name, value)
+        return None
+    if SCHEME_SOURCE_RE.match(value) or HOST_SOURCE_RE.match(value):
+        return None
+    return 'Invalid source expression for %s: %r' % (name, value)
+
+
+def validate_directive(name, value):
+    try:
+        CSPCompiler.ensure_directive(name)
+        CSPCompiler({}).compile_directive(name, value)
+    except InvalidCSPError as e:
+        return [str(e)]
+    if name not in CSPCompiler.CSP_LISTS or not value or (name in NON_SOURCE_LISTS and name != 'plugin-types'):
+        return []
+    return [error for error in (validate_source(name, item) for item in value) if error]
+
+
+def validate_csp(csp):
+    if isinstance(csp, str) or callable(csp):
+        return []
+    if not isinstance(csp, dict):
+        return ['A policy must be a dict or a string, not %s' % (type(csp).__name__,)]
+    errors = []
+    for name, value in csp.items():
+        if name == 'override' or callable(value):
+            continue
+        errors.extend(validate_directive(name, value))
+    return errors
+
+
+class CheckedCallable(object):
+    # Results are validated on the first call only; later failures are caught when compiling.
+    def __init__(self, func, name=None):
+        self.func = func
+        self.name = name
+        self.checked = False
+
+    @property
+    def csp_memo_key(self):
+        return getattr(self.func, 'csp_memo_key', self.func)
+
+    def __call__(self, request, response):
+        result = self.func(request, response)
+        if self.checked:
+            return result
+        self.checked = True
+        if isawaitable(result):
+            return self.acheck(result)
+        self.check(result)
+        return result
+
+    async def acheck(self, result):
+        result = await result
+        self.check(result)
+        return result
+
+    def check(self, result):
+        errors = validate_csp(result) if self.name is None else validate_directive(self.name, result)
+        for error in errors:
+            log.warning('CSP callable %r returned an invalid value: %s', self.func, error)
+
+
+def check_callables(csp):
+    if isinstance(csp, CheckedCallable):
+        return csp
+    if callable(csp):
+        return CheckedCallable(csp)
+    if not isinstance(csp, dict):
+        return csp
+    return {name: CheckedCallable(value, name) if callable(value) and not isinstance(value, CheckedCallable)
+            else value for name, value in csp.items()}
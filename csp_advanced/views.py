@@ -1,3 +1,46 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-# Create your views here.
+from csp_advanced.metrics import get_metrics_backend
+from csp_advanced.reports import CSP_REPORT_CONTENT_TYPES, get_report_queue
+
+
+@csrf_exempt
+@require_POST
+def report(request):
+    if request.content_type not in CSP_REPORT_CONTENT_TYPES:
+        return HttpResponse(status=415)
+
+    max_size = getattr(settings, 'ADVANCED_CSP_REPORT_MAX_SIZE', 65536)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > max_size:
+        return HttpResponse(status=413)
+
+    # Parsing and storage happen on the report queue's worker thread.
+    get_report_queue().put(request.body)
+    return HttpResponse(status=204)
+
+
+def can_view_metrics(request):
+    token = getattr(settings, 'ADVANCED_CSP_METRICS_TOKEN', None)
+    if token:
+        scheme, _, value = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and constant_time_compare(value.strip(), token):
+            return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_active and user.is_staff
+
+
+def metrics(request):
+    if not can_view_metrics(request):
+        return HttpResponseForbidden()
+    backend = get_metrics_backend()
+    if not hasattr(backend, 'render'):
+        raise Http404('No CSP metrics exporter configured')
+    return HttpResponse(backend.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,112 @@
+import atexit
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+URI_MAX_LENGTH = 512
+
+
+def violation_fingerprint(directive, blocked_uri, document_uri):
+    key = '\0'.join((directive or '', blocked_uri or '', document_uri or ''))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class ViolationStore(object):
+    def __init__(self, flush_interval=None, max_samples=None):
+        self.flush_interval = flush_interval
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.last_flush = time.monotonic()
+
+    def get_flush_interval(self):
+        if self.flush_interval is None:
+            return getattr(settings, 'ADVANCED_CSP_VIOLATION_FLUSH_INTERVAL', 10.0)
+        return self.flush_interval
+
+    def get_max_samples(self):
+        if self.max_samples is None:
+            return getattr(settings, 'ADVANCED_CSP_VIOLATION_SAMPLES', 3)
+        return self.max_samples
+
+    def __call__(self, reports):
+        self.add(reports)
+        if time.monotonic() - self.last_flush >= self.get_flush_interval():
+            self.flush()
+
+    def add(self, reports):
+        now = timezone.now()
+        max_samples = self.get_max_samples()
+        with self.lock:
+            for report in reports:
+                directive = report.get('effective_directive') or ''
+                blocked_uri = report.get('blocked_uri') or ''
+                document_uri = report.get('document_uri') or ''
+                fingerprint = violation_fingerprint(directive, blocked_uri, document_uri)
+
+                entry = self.buffer.get(fingerprint)
+                if entry is None:
+                    entry = self.buffer[fingerprint] = {
+                        'directive': directive[:64],
+                        'blocked_uri': blocked_uri[:URI_MAX_LENGTH],
+                        'document_uri': document_uri[:URI_MAX_LENGTH],
+                        'count': 0,
+                        'first_seen': now,
+                        'samples': [],
+                    }
+                entry['count'] += 1
+                entry['last_seen'] = now
+                if len(entry['samples']) < max_samples:
+                    entry['samples'].append(report.get('raw'))
+
+    def flush(self):
+        from csp_advanced.models import CSPViolation
+
+        with self.lock:
+            buffer, self.buffer = self.buffer, {}
+            self.last_flush = time.monotonic()
+        if not buffer:
+            return
+
+        # Flushes usually run on the report queue's thread, outside the request cycle.
+        close_old_connections()
+        max_samples = self.get_max_samples()
+        with transaction.atomic():
+            self.update_existing(buffer, max_samples)
+            while buffer:
+                try:
+                    with transaction.atomic():
+                        CSPViolation.objects.bulk_create([
+                            CSPViolation(fingerprint=fingerprint, **entry) for fingerprint, entry in buffer.items()
+                        ])
+                    break
+                except IntegrityError:
+                    # Another process inserted some of these fingerprints first: add to its counts instead.
+                    if not self.update_existing(buffer, max_samples):
+                        raise
+
+    @staticmethod
+    def update_existing(buffer, max_samples):
+        from csp_advanced.models import CSPViolation
+
+        existing = CSPViolation.objects.select_for_update().filter(fingerprint__in=list(buffer))
+        updated = []
+        for violation in existing:
+            entry = buffer.pop(violation.fingerprint)
+            violation.count = F('count') + entry['count']
+            violation.last_seen = entry['last_seen']
+            if len(violation.samples) < max_samples:
+                violation.samples = (violation.samples + entry['samples'])[:max_samples]
+            updated.append(violation)
+        if updated:
+            CSPViolation.objects.bulk_update(updated, ['count', 'last_seen', 'samples'])
+        return len(updated)
+
+
+store_reports = ViolationStore()
+atexit.register(store_reports.flush)
@@ -13,9 +13,11 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
-from django.urls import path
+from django.urls import include, path
 from django.contrib import admin
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('csp/', include('csp_advanced.urls')),
+    path('csp-metrics/', include('csp_advanced.metrics_urls')),
 ]